@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import platform
+import argparse
+import tempfile
+import contextlib
+
+import create
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'service'))
+from PublicationAPI import PublicationAPI
+
+"""
+  Words the synthetic corpus builds author names, titles, and venues from.
+"""
+GIVEN_NAMES = ['Ann', 'Bob', 'Carla', 'David', 'Evangelia', 'Feng', 'Geoffrey',
+               'Hiroshi', 'Ines', 'Jose', 'Karen', 'Li', 'Mohit', 'Nadia', 'Omar',
+               'Priya', 'Quentin', 'Rosa', 'Shaden', 'Tomas', 'Uma', 'Victor',
+               'Wei', 'Xavier', 'Yuki', 'Zoe']
+SURNAMES = ['Anastasiu', 'Brown', 'Christakopoulou', 'Dubois', 'Evans', 'Fischer',
+            'Garcia', 'Hinton', 'Ivanov', 'Jones', 'Kim', 'Lee', 'Muller', 'Nguyen',
+            'Okafor', 'Patel', 'Quinn', 'Rossi', 'Smith', 'Sharma', 'Tanaka',
+            'Umarov', 'Varga', 'Wang', 'Xu', 'Yilmaz', 'Zhang']
+TITLE_WORDS = ['adaptive', 'analysis', 'big', 'cache', 'circuits', 'data', 'design',
+               'distributed', 'efficient', 'embedded', 'energy', 'fast', 'graph',
+               'hardware', 'learning', 'low', 'memory', 'models', 'network',
+               'parallel', 'power', 'processor', 'recommender', 'scalable',
+               'scheduling', 'sparse', 'systems', 'verification', 'wireless']
+VENUES = ['DAC', 'ICCAD', 'ISCA', 'MICRO', 'DATE', 'ICWE', 'KDD', 'NIPS', 'ICML',
+          'IEEE Trans. on Computers', 'IEEE Micro', 'ACM Computing Surveys']
+
+"""
+  Writes a deterministic 'pubs.txt'-format corpus of 'publications' records to
+  'path'. Every paper has between 1 and 2 * 'authors_per_paper' - 1 authors
+  drawn from a pool of 'authors' unique names, and a 'broken' share of the
+  titles contain the <i> and <sup> tags that cleanUp repairs. The same
+  arguments always produce the same file.
+"""
+def generateCorpus(path, publications, authors_per_paper=3, broken=0.02,
+    authors=None, seed=0):
+  rng = random.Random(seed)
+  authors = authors or max(publications // 2, 1)
+  names = []
+  for i in range(authors):
+    name = '{0} {1}. {2}'.format(GIVEN_NAMES[i % 26], chr(ord('A') + i // 26 % 26),
+                                  SURNAMES[i // 676 % len(SURNAMES)])
+    names.append(name if i < 676 * len(SURNAMES) else '{0} {1}'.format(name, i))
+
+  with open(path, 'w') as f:
+    for i in range(publications):
+      words = [rng.choice(TITLE_WORDS) for w in range(rng.randint(3, 8))]
+      words[0] = words[0].capitalize()
+      if rng.random() < broken:
+        k = rng.randrange(len(words))
+        words[k] = rng.choice(['<i>{0}</i>', 'x<sup>{0}</sup>']).format(words[k])
+      count = rng.randint(1, 2 * authors_per_paper - 1)
+      first = rng.randint(1, 5000)
+      lines = ['<pub>', '\t<ID>{0}</ID>'.format(i), '\t<title>{0} {1}</title>'.format(' '.join(words), i),
+               '\t<year>{0}</year>'.format(rng.randint(1970, 2016))]
+      if rng.random() < 0.9:
+        lines.append('\t<booktitle>{0}</booktitle>'.format(rng.choice(VENUES)))
+      lines.extend(['\t<pages>{0}-{1}</pages>'.format(first, first + rng.randint(1, 20)), '\t<authors>'])
+      lines.extend('\t\t<author>{0}</author>'.format(a) for a in rng.sample(names, min(count, len(names))))
+      lines.extend(['\t</authors>', '</pub>'])
+      f.write('\n'.join(lines) + '\n')
+
+"""
+  Context manager that sends everything printed inside of it to os.devnull,
+  so the progress reports of create.py do not clutter the results.
+"""
+@contextlib.contextmanager
+def quiet():
+  stdout = sys.stdout
+  with open(os.devnull, 'w') as sys.stdout:
+    try:
+      yield
+    finally:
+      sys.stdout = stdout
+
+"""
+  Calls fn 'repeat' times and returns the summary of the elapsed times along
+  with the name of the benchmark.
+"""
+def measure(name, fn, repeat=1, **info):
+  times = []
+  for i in range(repeat):
+    with quiet():
+      start = time.time()
+      fn()
+      times.append(time.time() - start)
+  times.sort()
+  result = {'name': name, 'repeat': repeat, 'min': times[0], 'max': times[-1],
+            'median': times[len(times) // 2], 'mean': sum(times) / len(times)}
+  result.update(info)
+  print("{0:<60} {1:>10.6f}s".format(name, result['median']))
+
+  return result
+
+"""
+  Benchmarks parsing the corpus serially and with 'workers' processes.
+"""
+def benchmarkParse(corpus, workers=1, repeat=1):
+  results = [measure('parse', lambda: create.parsePublications(corpus), repeat)]
+  if workers > 1:
+    results.append(measure('parse/workers={0}'.format(workers),
+      lambda: create.parsePublications(corpus, workers), repeat, workers=workers))
+
+  return results
+
+"""
+  Benchmarks every phase of building the database at 'database' from the
+  corpus: creating the tables, inserting the rows, and building the indexes,
+  the full-text index, and the co-author graph. Leaves the built database
+  behind.
+"""
+def benchmarkLoad(corpus, database):
+  records = create.parsePublications(corpus)
+  if os.path.isfile(database):
+    os.remove(database)
+  conn = create.connectToDB(database)
+  results = [
+    measure('load/createTables', lambda: create.createTables(conn)),
+    measure('load/insertRows', lambda: create.insertRows(conn, records), records=len(records)),
+    measure('load/createIndexes', lambda: create.createIndexes(conn)),
+    measure('load/createSearchIndex', lambda: create.createSearchIndex(conn)),
+    measure('load/createCoauthorGraph', lambda: create.createCoauthorGraph(conn))
+  ]
+  conn.close()
+
+  return results
+
+"""
+  Returns 'count' queries drawn deterministically from the database: one
+  author, title word, year, and venue each.
+"""
+def sampleQueries(database, count, seed=0):
+  rng = random.Random(seed)
+  conn = sqlite3.connect(database)
+  conn.text_factory = str
+  rows = conn.execute("""SELECT p.title, p.year, p.booktitle, a.name
+                         FROM publication as p, written_by as w, author as a
+                         WHERE p.id = w.pub_id AND w.author_id = a.id""").fetchall()
+  conn.close()
+
+  samples = []
+  for title, year, booktitle, name in rng.sample(rows, min(count, len(rows))):
+    samples.append({'author': name, 'title': title, 'word': title.split()[0],
+                    'year': year, 'journal': booktitle or ''})
+
+  return samples
+
+"""
+  Benchmarks queryPublication for exact and fuzzy queries in every
+  sorted_order, at offset 0 and at 'offset', on every field of each sample.
+  The result cache is left off so every call reaches the database.
+"""
+def benchmarkQueries(database, samples, offset, repeat=5):
+  api = PublicationAPI(database)
+  fields = {
+    'author': lambda s, exact: [s['author'] if exact else s['author'].split()[-1], '', None, ''],
+    'title': lambda s, exact: ['', s['title'] if exact else s['word'], None, ''],
+    'year': lambda s, exact: ['', '', s['year'], ''],
+    'journal': lambda s, exact: ['', '', None, s['journal']]
+  }
+
+  results = []
+  for exact in [True, False]:
+    for field in sorted(fields):
+      for sorted_order in ['title', 'year', 'booktitle', 'name'] + ([] if exact else ['rank']):
+        for start in sorted(set([0, offset])):
+          queryRange = '{0},50'.format(start)
+          queries = [fields[field](s, exact) for s in samples]
+          results.append(measure('query/{0}/{1}/{2}/{3}'.format('exact' if exact else 'fuzzy',
+            field, sorted_order, queryRange),
+            lambda: [api.queryPublication(q, exact, 'JSON', sorted_order, False, queryRange)
+                     for q in queries], repeat,
+            mode='exact' if exact else 'fuzzy', field=field, sorted_order=sorted_order,
+            queryRange=queryRange, queries=len(queries)))
+  api.close()
+
+  return results
+
+"""
+  Benchmarks inserting 'count' new publications into a copy of the database
+  one at a time with insertPublication and again in one batch with
+  insertPublications.
+"""
+def benchmarkInserts(database, count, seed=0):
+  rng = random.Random(seed)
+  records = []
+  for i in range(count):
+    authors = ['{0} {1}'.format(rng.choice(GIVEN_NAMES), rng.choice(SURNAMES))
+               for a in range(rng.randint(1, 4))]
+    records.append(['Benchmark insert {0}'.format(i), rng.randint(1970, 2016),
+                    rng.choice(VENUES), '1-2', authors])
+
+  results = []
+  for name, insert in [('insert/single', lambda api: [api.insertPublication(r) for r in records]),
+                       ('insert/batch', lambda api: api.insertPublications(records))]:
+    copy = database + '.insert'
+    shutil.copy(database, copy)
+    api = PublicationAPI(copy)
+    results.append(measure(name, lambda: insert(api), records=count))
+    api.close()
+    os.remove(copy)
+
+  return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Benchmarks create.py and PublicationAPI on a synthetic 'pubs.txt'.")
+  parser.add_argument('-n', '--publications', type=int, default=20000,
+      help="number of publications in the corpus (default: 20000)")
+  parser.add_argument('-a', '--authors-per-paper', type=int, default=3,
+      help="mean number of authors per publication (default: 3)")
+  parser.add_argument('-b', '--broken', type=float, default=0.02,
+      help="share of titles with <i> or <sup> tags (default: 0.02)")
+  parser.add_argument('-s', '--seed', type=int, default=0,
+      help="seed of the corpus and the sampled queries (default: 0)")
+  parser.add_argument('-w', '--workers', type=int, default=1,
+      help="number of processes of the parallel parse benchmark (default: 1)")
+  parser.add_argument('-q', '--queries', type=int, default=20,
+      help="number of sampled queries per benchmark (default: 20)")
+  parser.add_argument('-r', '--repeat', type=int, default=5,
+      help="number of times each query benchmark is run (default: 5)")
+  parser.add_argument('-i', '--inserts', type=int, default=1000,
+      help="number of publications inserted by the insert benchmarks (default: 1000)")
+  parser.add_argument('-o', '--output', default='benchmark.json',
+      help="file the results are written to as JSON (default: benchmark.json)")
+  args = parser.parse_args()
+
+  directory = tempfile.mkdtemp()
+  try:
+    corpus = os.path.join(directory, 'pubs.txt')
+    database = os.path.join(directory, 'database.db')
+    generateCorpus(corpus, args.publications, args.authors_per_paper, args.broken, seed=args.seed)
+
+    results = benchmarkParse(corpus, args.workers)
+    results.extend(benchmarkLoad(corpus, database))
+    results.extend(benchmarkQueries(database, sampleQueries(database, args.queries, args.seed),
+                                    args.publications // 2, args.repeat))
+    results.extend(benchmarkInserts(database, args.inserts, args.seed))
+  finally:
+    shutil.rmtree(directory)
+
+  with open(args.output, 'w') as f:
+    json.dump({'parameters': vars(args), 'python': platform.python_version(),
+               'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, f, indent=2)
+  print("\nResults written to {0}".format(args.output))
@@ -1,86 +1,480 @@
 import os
 import sys
 import time
-import math
-import cPickle
+import mmap
+import array
+import shutil
+import struct
+import hashlib
 import sqlite3
+import tempfile
+import argparse
+import multiprocessing
 from sqlite3 import Error
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'service'))
+from PublicationAPI import nameTokens
+
+"""
+  Metrics object that timer, the parse stages, and insertRows record into,
+  or None to record nothing. Set by the --metrics option. Only the serial
+  parse records the readFile, processData, and cleanUp stages; the worker
+  processes of a parallel parse do not report back.
+"""
+METRICS = None
+
 """
     Takes in a function and list of arguments, times the execution of that
     function on those arguments, prints the elapsed time, and returns the
     result of the evaluated function.
 """
-def timer(fn, args):
+def timer(fn, *args):
   print("\nExecuting {0}...".format(fn.__name__))
   start = time.time()
-  result = fn(args)
-  print("Elapsed time: {0}".format(time.time() - start))
+  result = fn(*args)
+  elapsed = time.time() - start
+  print("Elapsed time: {0}".format(elapsed))
+  if METRICS is not None:
+    METRICS.observe('create_phase_seconds', elapsed, phase=fn.__name__)
   return result
 
 """
-  Converts the 'pubs.txt' file into a list of 'record' dictionaries.
+  Number of characters read from 'pubs.txt' per chunk by the streaming parser.
+"""
+CHUNK_SIZE = 1 << 20
+
+"""
+  Approximate number of bytes of 'pubs.txt' handed to a parallel parse worker
+  at a time.
 """
-def parsePublications(path):
+RANGE_SIZE = 1 << 24
+
+"""
+  Number of ranges per worker that the parallel parse keeps queued or parsed
+  ahead of the records being consumed.
+"""
+RANGES_IN_FLIGHT = 2
+
+"""
+  Table of distinct strings that hands out an integer ID per string in the
+  order they are first seen, so that records can refer to a name by its ID and
+  every distinct name is held in memory once.
+"""
+class StringTable(object):
+  def __init__(self):
+    self.ids = {}
+    self.strings = []
 
   """
-    Returns a list of partially processed records (lists of attribute tags).
+    Returns the ID of 'value', adding it to the table if it has not been
+    seen before.
   """
-  def readFile():
-    with open(path, 'r') as f:
-      data = f.read()
-    for string in ['\n', '<pub>', '<authors>', '</authors>']:
-      data = data.replace(string, '')
-    data = data.split('</pub>')
+  def intern(self, value):
+    index = self.ids.get(value)
+    if index is None:
+      index = self.ids[value] = len(self.strings)
+      self.strings.append(value)
+    return index
+
+  def __getitem__(self, index):
+    return self.strings[index]
 
-    return list(filter(None,
-      [list(filter(None, l)) for l in [r.split('\t') for r in data]]))
+"""
+  The author and venue names of every record parsed or loaded by this
+  process. insertRows uses the author IDs as the IDs of the 'author'
+  relation.
+"""
+AUTHORS = StringTable()
+VENUES = StringTable()
+
+"""
+  A parsed publication. The venue is its ID in VENUES (-1 if it has none) and
+  the authors are an array of IDs in AUTHORS, in the order they were written.
+  The other attributes are the strings of 'pubs.txt', or None if missing.
+  Records are pickled with their names, so that they can be sent between
+  processes that have their own tables.
+"""
+class Publication(object):
+  __slots__ = ['id', 'title', 'year', 'venue', 'pages', 'authors']
+
+  def __init__(self, id, title, year, venue, pages, authors):
+    self.id, self.title, self.year, self.pages = id, title, year, pages
+    self.venue, self.authors = venue, authors
+
+  @property
+  def booktitle(self):
+    return None if self.venue == -1 else VENUES[self.venue]
 
   """
-    Strips attribute tags off of data, enters them into record dictionaries,
-    and returns a list of dictionaries.
+    Returns the list of the author names of the record.
   """
-  def processData():
-    records = []
-    trash = []
-    for d in data:
-      record = {'authors':[]}
-      dirty = {'authors':[]}
-      for i in d:
-        attr = ''.join(i[1:-1].split('>')[1:]).split('</')
-        if attr[1] == 'author':
-          record['authors'].append(attr[0])
-          dirty['authors'].append(attr[0])
-        else:
-          record[attr[1].lower()] = attr[0]
-          dirty[attr[1].lower()] = attr[0]
-      if 'title' in record.keys():
-        records.append(record)
-      else:
-        trash.append(dirty)
-
-    return records + cleanUp(trash)
+  def authorNames(self):
+    return [AUTHORS[a] for a in self.authors]
+
+  def __reduce__(self):
+    return (internRecord, (self.id, self.title, self.year, self.booktitle, self.pages,
+                           self.authorNames()))
+
+"""
+  Returns a Publication of the given attributes, interning 'booktitle' and the
+  list of author names 'authors'.
+"""
+def internRecord(id, title, year, booktitle, pages, authors):
+  return Publication(id, title, year, -1 if booktitle is None else VENUES.intern(booktitle),
+                     pages, array.array('i', [AUTHORS.intern(a) for a in authors]))
+
+"""
+  Reads the 'pubs.txt' file at 'path' in fixed-size chunks and yields one
+  partially processed record (list of attribute tags) at a time, so only a
+  single chunk plus the record being assembled are ever held in memory. Only
+  the bytes in [start, end) are read when a range is given.
+"""
+def readFile(path, chunk_size=CHUNK_SIZE, start=0, end=None):
+  with open(path, 'rb') as f:
+    f.seek(start)
+    remaining = None if end is None else end - start
+    buf = ''
+    while True:
+      began = time.time() if METRICS is not None else 0
+      chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+      if not chunk:
+        break
+      if remaining is not None:
+        remaining -= len(chunk)
+      buf += chunk
+      pubs = buf.split('</pub>')
+      buf = pubs.pop()
+      if METRICS is not None:
+        METRICS.observe('create_stage_seconds', time.time() - began, stage='readFile')
+      for pub in pubs:
+        tags = splitRecord(pub)
+        if tags:
+          yield tags
+
+    tags = splitRecord(buf)
+    if tags:
+      yield tags
+
+"""
+  Removes the record delimiters from one '<pub>' block and returns the list of
+  attribute tags inside of it.
+"""
+def splitRecord(pub):
+  for string in ['\n', '<pub>', '<authors>', '</authors>']:
+    pub = pub.replace(string, '')
+
+  return list(filter(None, pub.split('\t')))
+
+"""
+  Strips attribute tags off of a list of tags and returns the Publication
+  they describe. Records without a clean title are passed on to cleanUp
+  first.
+"""
+def processData(tags):
+  start = time.time() if METRICS is not None else 0
+  record, authors = {}, []
+  for i in tags:
+    attr = ''.join(i[1:-1].split('>')[1:]).split('</')
+    if attr[1] == 'author':
+      authors.append(attr[0])
+    else:
+      record[attr[1].lower()] = attr[0]
+
+  record = record if 'title' in record else cleanUp(record)
+  pub = internRecord(record.get('id'), record['title'], record.get('year'),
+                     record.get('booktitle'), record.get('pages'), authors)
+  if METRICS is not None:
+    METRICS.observe('create_stage_seconds', time.time() - start, stage='processData')
+  return pub
+
+"""
+  Fixes the broken title attribute of a dictionary of record attributes and
+  returns it.
+"""
+def cleanUp(record):
+  start = time.time() if METRICS is not None else 0
+  allowed_keys = ['author', 'authors', 'pages', 'id', 'year', 'booktitle']
+  dirty_key = [k for k in record.keys() if k not in allowed_keys][0]
+  key = dirty_key[1:] if dirty_key[0] == 'i' else dirty_key
+  value = record.pop(dirty_key)
+
+  for string in ['<i', 'sup', '<sub', '<']:
+    value, key = value.replace(string, ''), key.replace(string, '')
+
+  record['title'] = value + key
+
+  if METRICS is not None:
+    METRICS.observe('create_stage_seconds', time.time() - start, stage='cleanUp')
+  return record
+
+"""
+  Splits the 'pubs.txt' file into byte ranges of roughly 'range_size' bytes
+  (at least 'parts' of them) that each end right after a '</pub>' tag, so
+  every range holds whole records. Returns a list of (start, end) tuples.
+"""
+def splitFile(path, parts, range_size=RANGE_SIZE):
+  size = os.path.getsize(path)
+  parts = max(parts, size // range_size + 1)
+  boundaries = [0]
+  with open(path, 'rb') as f:
+    for k in range(1, parts):
+      target = max(size * k // parts, boundaries[-1])
+      f.seek(target)
+      buf, offset = '', target
+      while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+          break
+        buf += chunk
+        index = buf.find('</pub>')
+        if index != -1:
+          boundaries.append(offset + index + len('</pub>'))
+          break
+        drop = max(len(buf) - len('</pub>') + 1, 0)
+        buf, offset = buf[drop:], offset + drop
+
+  boundaries = sorted(set(b for b in boundaries if b < size) | set([size]))
+  return list(zip(boundaries[:-1], boundaries[1:]))
+
+"""
+  Parses the records in one byte range of 'pubs.txt'. Used as the worker
+  function of the parallel parse, so it takes a single (path, chunk_size,
+  start, end) tuple and returns a list.
+"""
+def parseRange(args):
+  path, chunk_size, start, end = args
+  return [processData(tags) for tags in readFile(path, chunk_size, start, end)]
+
+"""
+  Generator that converts the 'pubs.txt' file into Publication records one
+  at a time, in file order. With more than one worker the file is split into
+  ranges on '</pub>' boundaries that are parsed by a pool of processes; the
+  records are yielded in the same order as the serial parse. At most
+  RANGES_IN_FLIGHT ranges per worker are handed out ahead of the one being
+  yielded, so a slow consumer holds a bounded number of parsed ranges rather
+  than the whole file.
+"""
+def iterPublications(path, chunk_size=CHUNK_SIZE, workers=1):
+  if workers <= 1:
+    for tags in readFile(path, chunk_size):
+      yield processData(tags)
+    return
+
+  ranges = [(path, chunk_size, start, end) for start, end in splitFile(path, workers)]
+  ranges.reverse()
+  pool = multiprocessing.Pool(workers)
+  try:
+    window = []
+    while ranges or window:
+      while ranges and len(window) < RANGES_IN_FLIGHT * workers:
+        window.append(pool.apply_async(parseRange, (ranges.pop(),)))
+      for record in window.pop(0).get():
+        yield record
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+"""
+  Converts the 'pubs.txt' file into a list of Publication records.
+"""
+def parsePublications(path, workers=1):
+  return list(iterPublications(path, workers=workers))
+
+"""
+  Layout of the 'pubs.dat' cache. The header holds the magic string, the
+  fingerprint of the source file (size, mtime, SHA-1), the number of records,
+  and an (offset, length) pair for each section in CACHE_SECTIONS:
+
+    strings       the id, title, year, and pages of every record, concatenated
+    string_ends   four little-endian uint64 end offsets into 'strings' per record
+    flags         one byte per record marking which CACHE_FIELDS are present
+    venues        one int32 per record indexing the venue table (-1 if missing)
+    author_ends   one uint32 per record, the running count of 'author_ids'
+    author_ids    uint32 indexes into the author table
+    author_heap   every distinct author name, concatenated
+    author_table  one uint64 end offset into 'author_heap' per author
+    venue_heap    every distinct booktitle, concatenated
+    venue_table   one uint64 end offset into 'venue_heap' per venue
+"""
+CACHE_MAGIC = 'PUBSDAT1'
+CACHE_HEADER = struct.Struct('<8sQd20sQ')
+CACHE_SECTIONS = ['strings', 'string_ends', 'flags', 'venues', 'author_ends',
+                  'author_ids', 'author_heap', 'author_table', 'venue_heap',
+                  'venue_table']
+CACHE_SECTION = struct.Struct('<QQ')
+CACHE_FIELDS = ['id', 'title', 'year', 'pages']
+
+"""
+  Returns the (size, mtime, SHA-1 digest) fingerprint of the file at 'path'.
+  The digest is only computed when 'digest' is True.
+"""
+def fileFingerprint(path, digest=True):
+  stat = os.stat(path)
+  sha1 = hashlib.sha1()
+  if digest:
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+        sha1.update(chunk)
+
+  return stat.st_size, stat.st_mtime, sha1.digest()
+
+"""
+  Returns the fingerprint stored in the header of the cache at 'path', or None
+  if the file is missing or is not a cache.
+"""
+def cacheFingerprint(path):
+  if not os.path.isfile(path):
+    return None
+  with open(path, 'rb') as f:
+    header = f.read(CACHE_HEADER.size)
+  if len(header) < CACHE_HEADER.size:
+    return None
+  magic, size, mtime, digest, count = CACHE_HEADER.unpack(header)
+
+  return (size, mtime, digest) if magic == CACHE_MAGIC else None
+
+"""
+  Returns True if the cache at 'path' was built from the current contents of
+  the 'source' file. The size is compared first and the hash is only computed
+  when the size matches but the modification time does not.
+"""
+def cacheIsFresh(path, source):
+  cached = cacheFingerprint(path)
+  if cached is None:
+    return False
+  size, mtime, digest = fileFingerprint(source, digest=False)
+  if size != cached[0]:
+    return False
+
+  return mtime == cached[1] or fileFingerprint(source)[2] == cached[2]
+
+"""
+  Returns the UTF-8 bytes of a cached string value.
+"""
+def toBytes(value):
+  return value.encode('utf-8') if isinstance(value, unicode) else str(value)
+
+"""
+  Passes records through unchanged while writing each one to the columnar
+  cache at 'path', fingerprinted with the 'source' file the records were
+  parsed from. Every column is spooled to its own temporary file as the records
+  stream by and only the author and venue tables, keyed by the IDs of AUTHORS
+  and VENUES, are kept in memory. The cache is moved into place once every
+  record has been written.
+"""
+def cacheRecords(records, path, source):
+  fingerprint = fileFingerprint(source)
+  sections = dict((name, tempfile.TemporaryFile()) for name in CACHE_SECTIONS)
+  tables = {'author': {}, 'venue': {}}
+  ends = {'strings': 0, 'author_ids': 0, 'author_heap': 0, 'venue_heap': 0}
 
   """
-    Fixes the broken title attributes and returns a list of dictionaries.
+    Returns the index of the name with ID 'key' in the author or venue table,
+    adding it to the table if it has not been seen before.
   """
-  def cleanUp(trash):
-    allowed_keys = ['author', 'authors', 'pages', 'id', 'year', 'booktitle']
-    for t in trash:
-      dirty_key = [k for k in t.keys() if k not in allowed_keys][0]
-      key = dirty_key[1:] if dirty_key[0] == 'i' else dirty_key
-      value = t[dirty_key]
-      t.pop(dirty_key)
+  def intern(table, key):
+    index = tables[table].get(key)
+    if index is None:
+      index = tables[table][key] = len(tables[table])
+      data = toBytes((AUTHORS if table == 'author' else VENUES)[key])
+      sections[table + '_heap'].write(data)
+      ends[table + '_heap'] += len(data)
+      sections[table + '_table'].write(struct.pack('<Q', ends[table + '_heap']))
+    return index
 
-      for string in ['<i', 'sup', '<sub', '<']:
-        value, key = value.replace(string, ''), key.replace(string, '')
+  count = 0
+  for record in records:
+    flags, string_ends = 0, []
+    for bit, field in enumerate(CACHE_FIELDS):
+      value = getattr(record, field)
+      if value is not None:
+        flags |= 1 << bit
+        data = toBytes(value)
+        sections['strings'].write(data)
+        ends['strings'] += len(data)
+      string_ends.append(ends['strings'])
+    sections['string_ends'].write(struct.pack('<4Q', *string_ends))
+    sections['flags'].write(struct.pack('<B', flags))
 
-      t['title'] = value + key
+    venue = record.venue
+    sections['venues'].write(struct.pack('<i', -1 if venue == -1 else intern('venue', venue)))
 
-    return trash
+    ids = [intern('author', author) for author in record.authors]
+    sections['author_ids'].write(struct.pack('<{0}I'.format(len(ids)), *ids))
+    ends['author_ids'] += len(ids)
+    sections['author_ends'].write(struct.pack('<I', ends['author_ids']))
 
-  data = readFile()
-  return processData()
+    count += 1
+    yield record
+
+  with open(path + '.tmp', 'wb') as f:
+    f.write(CACHE_HEADER.pack(CACHE_MAGIC, fingerprint[0], fingerprint[1], fingerprint[2], count))
+    offset = CACHE_HEADER.size + CACHE_SECTION.size * len(CACHE_SECTIONS)
+    for name in CACHE_SECTIONS:
+      length = sections[name].tell()
+      f.write(CACHE_SECTION.pack(offset, length))
+      offset += length
+    for name in CACHE_SECTIONS:
+      sections[name].seek(0)
+      shutil.copyfileobj(sections[name], f)
+      sections[name].close()
+  os.rename(path + '.tmp', path)
+
+"""
+  Generator that memory-maps the cache written by cacheRecords and decodes one
+  Publication at a time, so records start streaming as soon as the header has
+  been read. Each name of the cache's author and venue tables is read and
+  interned once, the first time a record refers to it.
+"""
+def loadRecords(path):
+  with open(path, 'rb') as f:
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  try:
+    count = CACHE_HEADER.unpack_from(mm, 0)[4]
+    sections, lengths = {}, {}
+    for i, name in enumerate(CACHE_SECTIONS):
+      sections[name], lengths[name] = CACHE_SECTION.unpack_from(
+        mm, CACHE_HEADER.size + i * CACHE_SECTION.size)
+    ids = {'author': array.array('i', [-1]) * (lengths['author_table'] // 8),
+           'venue': array.array('i', [-1]) * (lengths['venue_table'] // 8)}
+
+    """
+      Returns the ID in AUTHORS or VENUES of entry 'index' of the author or
+      venue table.
+    """
+    def lookup(table, index):
+      if ids[table][index] == -1:
+        position = sections[table + '_table'] + 8 * index
+        start = struct.unpack_from('<Q', mm, position - 8)[0] if index else 0
+        end = struct.unpack_from('<Q', mm, position)[0]
+        ids[table][index] = (AUTHORS if table == 'author' else VENUES).intern(
+          mm[sections[table + '_heap'] + start:sections[table + '_heap'] + end])
+      return ids[table][index]
+
+    string_start, author_start, i = 0, 0, 0
+    while i < count:
+      flags = ord(mm[sections['flags'] + i])
+      string_ends = struct.unpack_from('<4Q', mm, sections['string_ends'] + 32 * i)
+      fields = []
+      for bit in range(len(CACHE_FIELDS)):
+        fields.append(mm[sections['strings'] + string_start:sections['strings'] + string_ends[bit]]
+                      if flags & (1 << bit) else None)
+        string_start = string_ends[bit]
+
+      venue = struct.unpack_from('<i', mm, sections['venues'] + 4 * i)[0]
+      author_end = struct.unpack_from('<I', mm, sections['author_ends'] + 4 * i)[0]
+      authors = struct.unpack_from('<{0}I'.format(author_end - author_start), mm,
+                                   sections['author_ids'] + 4 * author_start)
+      author_start = author_end
+
+      i += 1
+      yield Publication(fields[0], fields[1], fields[2],
+                        -1 if venue == -1 else lookup('venue', venue), fields[3],
+                        array.array('i', [lookup('author', index) for index in authors]))
+  finally:
+    mm.close()
 
 
 """
@@ -90,6 +484,7 @@ def parsePublications(path):
 def connectToDB(db_file):
   try:
     conn = sqlite3.connect(db_file)
+    conn.text_factory = str # Lets 8-bit strings from 'pubs.txt' be bound as parameters
   except Error as e:
     print(e)
 
@@ -124,6 +519,21 @@ def createTables(conn):
                           ON DELETE CASCADE,
                           PRIMARY KEY (pub_id, author_id)
                         );
+
+                        CREATE TABLE IF NOT EXISTS author_token(
+                          token VARCHAR(150),
+                          author_id INT,
+                          FOREIGN KEY (author_id) REFERENCES author
+                          ON DELETE CASCADE,
+                          PRIMARY KEY (token, author_id)
+                        );
+
+                        CREATE TABLE IF NOT EXISTS publication_digest(
+                          pub_id INT PRIMARY KEY,
+                          digest INT NOT NULL,
+                          FOREIGN KEY (pub_id) REFERENCES publication
+                          ON DELETE CASCADE
+                        );
                      """.format(current_year)
 
   try:
@@ -133,104 +543,629 @@ def createTables(conn):
   except Error as e:
     print(e)
 
+"""
+  Number of publications buffered before their rows are sent to the database
+  with executemany in insertRows. A progress report is printed per batch.
+"""
+BATCH_SIZE = 10000
+
+"""
+  Turns off journaling, syncing, and foreign key enforcement for the duration
+  of a bulk load. Foreign keys are checked once the load is finished by
+  endBulkLoad.
+"""
+def beginBulkLoad(conn):
+  conn.commit()
+  for pragma in ['journal_mode = OFF', 'synchronous = OFF', 'foreign_keys = OFF',
+                 'temp_store = MEMORY', 'cache_size = -262144']:
+    conn.execute('PRAGMA ' + pragma).fetchall()
+
+"""
+  Restores the journaling, syncing, and foreign key enforcement that
+  beginBulkLoad turned off.
+"""
+def restoreBulkLoad(conn):
+  for pragma in ['journal_mode = DELETE', 'synchronous = FULL', 'foreign_keys = ON']:
+    conn.execute('PRAGMA ' + pragma).fetchall()
+
+"""
+  Removes 'written_by' and 'publication_digest' rows whose publication was
+  rejected during the load, restores journaling and syncing, and turns
+  foreign keys back on. Returns the number of 'written_by' rows that were
+  removed.
+"""
+def endBulkLoad(conn):
+  removed = conn.execute("""DELETE FROM written_by WHERE pub_id NOT IN (
+                              SELECT id FROM publication);""").rowcount
+  conn.execute("""DELETE FROM publication_digest WHERE pub_id NOT IN (
+                    SELECT id FROM publication);""")
+  conn.commit()
+  restoreBulkLoad(conn)
+
+  for row in conn.execute("""PRAGMA foreign_key_check;"""):
+    print(row)
+
+  return removed
+
+"""
+  Builds the secondary indexes. Called after insertRows so the indexes are
+  built once over the loaded data rather than maintained row by row. The name,
+  title, and booktitle indexes are on lower() expressions so that the
+  case-insensitive lookups in PublicationAPI can search them.
+"""
+def createIndexes(conn):
+  create_index_sql = """CREATE INDEX IF NOT EXISTS written_by_author_id
+                          ON written_by(author_id);
+
+                        CREATE INDEX IF NOT EXISTS author_token_author_id
+                          ON author_token(author_id);
+
+                        CREATE INDEX IF NOT EXISTS author_lower_name
+                          ON author(lower(name));
+
+                        CREATE INDEX IF NOT EXISTS publication_lower_title
+                          ON publication(lower(title));
+
+                        CREATE INDEX IF NOT EXISTS publication_lower_booktitle
+                          ON publication(lower(booktitle));
+
+                        CREATE INDEX IF NOT EXISTS publication_year_booktitle
+                          ON publication(year, lower(booktitle));
+
+                        ANALYZE;
+                     """
+
+  try:
+    c = conn.cursor()
+    c.executescript(create_index_sql)
+    c.close()
+  except Error as e:
+    print(e)
+
+"""
+  Builds the 'publication_fts' full-text index over the title, author names,
+  and booktitle of every publication, keyed by publication ID, and the
+  triggers that keep it in sync with 'publication', 'author', and
+  'written_by'. Called after insertRows so the index is filled in one pass
+  instead of by the triggers.
+"""
+def createSearchIndex(conn):
+  refresh_sql = """DELETE FROM publication_fts WHERE rowid IN ({0});
+                   INSERT INTO publication_fts(rowid, title, authors, booktitle)
+                     SELECT p.id, p.title,
+                       (SELECT group_concat(a.name, ', ') FROM written_by as w, author as a
+                        WHERE w.pub_id = p.id AND w.author_id = a.id),
+                       p.booktitle
+                     FROM publication as p WHERE p.id IN ({0});"""
+
+  create_search_sql = """CREATE VIRTUAL TABLE IF NOT EXISTS publication_fts
+                           USING fts5(title, authors, booktitle);
+
+                         DELETE FROM publication_fts;
+                         INSERT INTO publication_fts(rowid, title, authors, booktitle)
+                           SELECT p.id, p.title, group_concat(a.name, ', '), p.booktitle
+                           FROM publication as p
+                           LEFT JOIN written_by as w ON w.pub_id = p.id
+                           LEFT JOIN author as a ON a.id = w.author_id
+                           GROUP BY p.id;
+                         INSERT INTO publication_fts(publication_fts) VALUES('optimize');
+
+                         CREATE TRIGGER IF NOT EXISTS publication_fts_insert
+                         AFTER INSERT ON publication BEGIN
+                           {0}
+                         END;
+
+                         CREATE TRIGGER IF NOT EXISTS publication_fts_update
+                         AFTER UPDATE OF title, booktitle ON publication BEGIN
+                           {0}
+                         END;
+
+                         CREATE TRIGGER IF NOT EXISTS publication_fts_delete
+                         AFTER DELETE ON publication BEGIN
+                           DELETE FROM publication_fts WHERE rowid = old.id;
+                         END;
+
+                         CREATE TRIGGER IF NOT EXISTS written_by_fts_insert
+                         AFTER INSERT ON written_by BEGIN
+                           {1}
+                         END;
+
+                         CREATE TRIGGER IF NOT EXISTS written_by_fts_delete
+                         AFTER DELETE ON written_by BEGIN
+                           {2}
+                         END;
+
+                         CREATE TRIGGER IF NOT EXISTS author_fts_update
+                         AFTER UPDATE OF name ON author BEGIN
+                           {3}
+                         END;
+                      """.format(
+                        refresh_sql.format('new.id'),
+                        refresh_sql.format('new.pub_id'),
+                        refresh_sql.format('old.pub_id'),
+                        refresh_sql.format('SELECT pub_id FROM written_by WHERE author_id = new.id'))
+
+  try:
+    c = conn.cursor()
+    c.executescript(create_search_sql)
+    c.close()
+  except Error as e:
+    print(e)
+
+"""
+  Fixes the title and year of the ICWE 2004 workshop proceedings, whose title
+  holds its year, and returns the record.
+"""
+def fixRecord(pub):
+  if "Engineering Advanced Web Applications: Proceedings of Workshops in connection with the 4th International Conference on Web Engineering (ICWE 2004)" in pub.title:
+    string = pub.title.split(',')[0]
+    title, year = string.split('(ICWE ')[0], string.split('(ICWE ')[1].replace(')', '')
+    pub.title, pub.year = title, year
+
+  return pub
+
+"""
+  Returns the content hash of a record: the first 8 bytes of the SHA-1 of its
+  title, year, booktitle, pages, and authors as a signed integer, so that it
+  fits in an INT column.
+"""
+def recordDigest(pub):
+  fields = [pub.title, pub.year, pub.booktitle, pub.pages]
+  data = '\0'.join(['' if f is None else toBytes(f) for f in fields] +
+                    [toBytes(a) for a in pub.authorNames()])
+
+  return struct.unpack('<q', hashlib.sha1(data).digest()[:8])[0]
+
+"""
+  Returns the ID of a record as it is stored in the 'publication' relation.
+"""
+def recordId(pub):
+  return int(pub.id) if pub.id.isdigit() else pub.id
+
+"""
+  Builds the 'coauthor' relation, which holds for every pair of authors (a, b)
+  who have written a publication together the number of publications they
+  share, once in each direction, and the triggers on 'written_by' that keep it
+  exact as authorship rows are inserted and deleted. Called after insertRows
+  so the relation is filled in one pass instead of by the triggers.
+"""
+def createCoauthorGraph(conn):
+  others_sql = """SELECT author_id FROM written_by
+                  WHERE pub_id = {0}.pub_id AND author_id != {0}.author_id"""
+
+  create_coauthor_sql = """CREATE TABLE IF NOT EXISTS coauthor(
+                             a INT,
+                             b INT,
+                             count INT NOT NULL,
+                             PRIMARY KEY (a, b)
+                           );
+
+                           DELETE FROM coauthor;
+                           INSERT INTO coauthor
+                             SELECT w1.author_id, w2.author_id, count(*)
+                             FROM written_by as w1, written_by as w2
+                             WHERE w1.pub_id = w2.pub_id AND w1.author_id != w2.author_id
+                             GROUP BY w1.author_id, w2.author_id;
+
+                           CREATE INDEX IF NOT EXISTS coauthor_a_count
+                             ON coauthor(a, count);
+                           ANALYZE coauthor;
+
+                           CREATE TRIGGER IF NOT EXISTS written_by_coauthor_insert
+                           AFTER INSERT ON written_by BEGIN
+                             INSERT INTO coauthor
+                               SELECT new.author_id, author_id, 1 FROM ({0})
+                               WHERE true ON CONFLICT(a, b) DO UPDATE SET count = count + 1;
+                             INSERT INTO coauthor
+                               SELECT author_id, new.author_id, 1 FROM ({0})
+                               WHERE true ON CONFLICT(a, b) DO UPDATE SET count = count + 1;
+                           END;
+
+                           CREATE TRIGGER IF NOT EXISTS written_by_coauthor_delete
+                           AFTER DELETE ON written_by BEGIN
+                             UPDATE coauthor SET count = count - 1
+                               WHERE a = old.author_id AND b IN ({1});
+                             UPDATE coauthor SET count = count - 1
+                               WHERE b = old.author_id AND a IN ({1});
+                             DELETE FROM coauthor
+                               WHERE a = old.author_id AND b IN ({1}) AND count <= 0;
+                             DELETE FROM coauthor
+                               WHERE b = old.author_id AND a IN ({1}) AND count <= 0;
+                           END;
+                        """.format(others_sql.format('new'), others_sql.format('old'))
+
+  try:
+    c = conn.cursor()
+    c.executescript(create_coauthor_sql)
+    c.close()
+  except Error as e:
+    print(e)
+
+"""
+  Summary tables kept by createAggregates, each given as its key columns and
+  the relation, key expressions, and condition (if any) of the rows it
+  counts. The expressions are formatted with 'new' or 'old' inside the triggers.
+"""
+AGGREGATES = [
+  ('relation_count', ['relation'], 'publication', ["'publication'"], None),
+  ('relation_count', ['relation'], 'author', ["'author'"], None),
+  ('relation_count', ['relation'], 'written_by', ["'written_by'"], None),
+  ('year_count', ['year'], 'publication', ['{0}.year'], '{0}.year IS NOT NULL'),
+  ('venue_count', ['booktitle'], 'publication', ["ifnull({0}.booktitle, '')"], None),
+  ('venue_year_count', ['booktitle', 'year'], 'publication',
+   ["ifnull({0}.booktitle, '')", '{0}.year'], '{0}.year IS NOT NULL'),
+  ('author_count', ['author_id'], 'written_by', ['{0}.author_id'], None)
+]
+
+"""
+  Builds the summary tables that hold the number of rows of each relation and
+  of publications per year, per venue, per venue and year, and per author,
+  and the triggers on 'publication', 'author', and 'written_by' that keep
+  them exact. Venues are compared ignoring case, as they are by
+  PublicationAPI, and publications without a year are only counted per
+  venue. Called at the end of insertRows so the tables are filled in one pass
+  instead of by the triggers.
+"""
+def createAggregates(conn):
+  increment_sql = """INSERT INTO {0} SELECT {1}, 1 WHERE {2}
+                       ON CONFLICT({3}) DO UPDATE SET count = count + 1;"""
+  decrement_sql = """UPDATE {0} SET count = count - 1 WHERE {1};
+                     DELETE FROM {0} WHERE {1} AND count <= 0;"""
+
+  create_aggregate_sql = """CREATE TABLE IF NOT EXISTS relation_count(
+                              relation VARCHAR(20) PRIMARY KEY,
+                              count INT NOT NULL
+                            );
+
+                            CREATE TABLE IF NOT EXISTS year_count(
+                              year INT PRIMARY KEY,
+                              count INT NOT NULL
+                            );
+
+                            CREATE TABLE IF NOT EXISTS venue_count(
+                              booktitle VARCHAR(150) COLLATE NOCASE PRIMARY KEY,
+                              count INT NOT NULL
+                            );
+
+                            CREATE TABLE IF NOT EXISTS venue_year_count(
+                              booktitle VARCHAR(150) COLLATE NOCASE,
+                              year INT,
+                              count INT NOT NULL,
+                              PRIMARY KEY (booktitle, year)
+                            );
+
+                            CREATE TABLE IF NOT EXISTS author_count(
+                              author_id INT PRIMARY KEY,
+                              count INT NOT NULL
+                            );
+
+                            DELETE FROM relation_count;
+                            INSERT INTO relation_count VALUES
+                              ('publication', (SELECT count(*) FROM publication)),
+                              ('author', (SELECT count(*) FROM author)),
+                              ('written_by', (SELECT count(*) FROM written_by));
+
+                            DELETE FROM year_count;
+                            INSERT INTO year_count
+                              SELECT year, count(*) FROM publication
+                              WHERE year IS NOT NULL GROUP BY year;
+
+                            DELETE FROM venue_count;
+                            INSERT INTO venue_count
+                              SELECT ifnull(booktitle, ''), count(*) FROM publication
+                              GROUP BY ifnull(booktitle, '') COLLATE NOCASE;
+
+                            DELETE FROM venue_year_count;
+                            INSERT INTO venue_year_count
+                              SELECT ifnull(booktitle, ''), year, count(*) FROM publication
+                              WHERE year IS NOT NULL
+                              GROUP BY ifnull(booktitle, '') COLLATE NOCASE, year;
+
+                            DELETE FROM author_count;
+                            INSERT INTO author_count
+                              SELECT author_id, count(*) FROM written_by GROUP BY author_id;
+                         """
+
+  triggers = {}
+  for table, columns, relation, keys, condition in AGGREGATES:
+    for event, row in [('insert', 'new'), ('delete', 'old')]:
+      where = ' AND '.join(['{0} = {1}'.format(c, k) for c, k in zip(columns, keys)] +
+                           ([condition] if condition else []))
+      triggers.setdefault((relation, event), []).append(
+        increment_sql.format(table, ', '.join(keys), condition or 'true', ', '.join(columns)).format(row)
+        if event == 'insert' else decrement_sql.format(table, where).format(row))
+    if relation == 'publication' and table != 'relation_count':
+      triggers.setdefault((relation, 'update'), []).extend(
+        triggers[(relation, 'delete')][-1:] + triggers[(relation, 'insert')][-1:])
+  for (relation, event), statements in sorted(triggers.items()):
+    create_aggregate_sql += """
+                            CREATE TRIGGER IF NOT EXISTS {0}_aggregate_{1}
+                            AFTER {2} ON {0} BEGIN
+                              {3}
+                            END;
+                            """.format(relation, event,
+                              'UPDATE OF year, booktitle' if event == 'update' else event.upper(),
+                              '\n'.join(statements))
+
+  try:
+    c = conn.cursor()
+    c.executescript(create_aggregate_sql)
+    c.close()
+  except Error as e:
+    print(e)
+
+"""
+  Returns True if the database has a table or index named 'name'.
+"""
+def hasTable(conn, name):
+  return conn.execute("""SELECT count(*) FROM sqlite_master WHERE name = ?;""",
+                      (name,)).fetchone()[0] > 0
+
 """
   Inserts records into the 'publication', 'author', and 'written_by' relations.
+  'records' may be any iterable of Publication records, including the
+  generator returned by iterPublications. The IDs of the authors in AUTHORS
+  are used as their IDs in 'author'. Rows are sent in batches of
+  'batch_size' publications with executemany while journaling, syncing, and
+  foreign key checks are turned off. Publications rejected by the table
+  constraints are skipped. The content hash of every publication is stored in
+  'publication_digest' for updateRows, and the name tokens of every author in
+  'author_token'. The summary tables of createAggregates are filled once the
+  rows are in. If the load fails partway, journaling, syncing, and foreign
+  keys are restored before returning.
 """
-def insertRows(conn):
+def insertRows(conn, records, batch_size=BATCH_SIZE):
+  pub_sql = """INSERT OR IGNORE INTO publication VALUES(?, ?, ?, ?, ?);"""
+  author_sql = """INSERT INTO author VALUES(?, ?);"""
+  written_by_sql = """INSERT OR IGNORE INTO written_by VALUES(?, ?);"""
+  digest_sql = """INSERT OR IGNORE INTO publication_digest VALUES(?, ?);"""
+  token_sql = """INSERT OR IGNORE INTO author_token VALUES(?, ?);"""
+
   """
-    Inserts a publication ID and author ID into the 'written_by' relation.
+    Sends the buffered rows to the database and empties the buffers.
   """
-  def insertWrittenBy(pub, author):
-    written_by_sql = """INSERT INTO written_by VALUES({0}, {1});""".format(
-        pub['id'],
-        authors[author]
-      )
+  def flush():
+    start = time.time()
+    c.executemany(pub_sql, pub_rows)
+    c.executemany(author_sql, author_rows)
+    c.executemany(written_by_sql, written_by_rows)
+    c.executemany(digest_sql, digest_rows)
+    c.executemany(token_sql, token_rows)
+    if METRICS is not None:
+      METRICS.observe('create_stage_seconds', time.time() - start, stage='insertRows')
+      METRICS.increment('create_rows_inserted', len(pub_rows), relation='publication')
+      METRICS.increment('create_rows_inserted', len(author_rows), relation='author')
+      METRICS.increment('create_rows_inserted', len(written_by_rows), relation='written_by')
+    del pub_rows[:], author_rows[:], written_by_rows[:], digest_rows[:], token_rows[:]
+
+  loaded = False
+  try:
+    beginBulkLoad(conn)
+    c = conn.cursor()
+    inserted = bytearray()
+    pub_rows, author_rows, written_by_rows, digest_rows, token_rows = [], [], [], [], []
+    count = 0
+    for pub in records:
+      fixRecord(pub)
+      pub_rows.append((pub.id, pub.title, pub.year, pub.booktitle, pub.pages))
+      digest_rows.append((pub.id, recordDigest(pub)))
+      for author in pub.authors:
+        if author >= len(inserted):
+          inserted.extend(bytearray(max(author + 1 - len(inserted), len(inserted))))
+        if not inserted[author]:
+          inserted[author] = 1
+          author_rows.append((author, AUTHORS[author]))
+          token_rows.extend((token, author) for token in nameTokens(AUTHORS[author]))
+        written_by_rows.append((pub.id, author))
 
-    try:
-      c.execute(written_by_sql)
-    except Error as e:
-      pass
+      count += 1
+      if count % batch_size == 0:
+        flush()
+        print("{0}".format(count)) ,
+    flush()
+    conn.commit()
+    c.close()
 
+    removed = endBulkLoad(conn)
+    loaded = True
+    createAggregates(conn)
+    print("{0} records".format(count))
+    if removed:
+      print("Removed {0} 'written_by' rows of rejected publications".format(removed))
+  except Error as e:
+    print(e)
+  finally:
+    if not loaded:
+      conn.rollback()
+      restoreBulkLoad(conn)
+
+"""
+  Brings the relations of an existing database up to date with records, the
+  full contents of a newer 'pubs.txt'. Every record is compared with the
+  content hash stored for its ID in 'publication_digest', and only the
+  publications that are new or changed are written: each one is deleted along
+  with its 'written_by' rows and inserted again with its authors, in batches
+  of 'batch_size' publications per transaction. Publications whose IDs are no
+  longer in the records are deleted, as are the authors that are left without
+  publications, and new authors get their name tokens in 'author_token'. The
+  tokens of a database built before 'author_token' existed are filled in
+  first. Publications added through PublicationAPI have no content hash and
+  are left alone unless a record has the same ID, and records rejected by the
+  table constraints are left out as they are by insertRows. A database with no
+  content hashes at all, built before 'publication_digest' existed, cannot
+  tell those apart, so every one of its publications is treated as changed
+  and those whose IDs are not in the records are removed. Returns the
+  numbers of added, changed, removed, and unchanged publications.
+"""
+def updateRows(conn, records, batch_size=BATCH_SIZE):
   """
-    Inserts an author ID and author name into the 'author' relation.
+    Returns the IDs of the authors of the publications with the IDs in
+    'pub_ids', fetched in chunks small enough to be bound as parameters.
   """
-  def insertAuthors(pub):
-    for author in pub['authors']:
-      if author not in authors:
-        authors[author] = authors['author_id']
-        authors['author_id'] += 1
-        author_sql = """INSERT INTO author VALUES({0}, "{1}");""".format(
-          authors[author],
-          author.replace('\"', '\'')
-          )
-
-        try:
-          c.execute(author_sql)
-        except Error as e:
-          print(e, author_sql)
-
-      insertWrittenBy(pub, author)
+  def authorsOf(pub_ids):
+    found = set()
+    for i in range(0, len(pub_ids), 500):
+      chunk = pub_ids[i:i + 500]
+      found.update(r[0] for r in c.execute("""SELECT author_id FROM written_by
+        WHERE pub_id IN ({0});""".format(', '.join(['?'] * len(chunk))), chunk))
+    return found
 
   """
-    Inserts a publication ID, title, year, booktitle (journal), and page range
-    into the 'publication' relation.
+    Deletes the authors with IDs in 'author_ids' that no longer have any
+    publications.
   """
-  def insertPublication(pub):
-    if "Engineering Advanced Web Applications: Proceedings of Workshops in connection with the 4th International Conference on Web Engineering (ICWE 2004)" in pub['title']:
-      string = pub['title'].split(',')[0]
-      title, year = string.split('(ICWE ')[0], string.split('(ICWE ')[1].replace(')', '')
-      pub['title'], pub['year'] = title, year
-
-    pub_sql = """INSERT INTO publication VALUES({0}, "{1}", {2}, "{3}", "{4}");""".format(
-      pub['id'],
-      pub['title'].replace('\"', '\''),
-      pub['year'],
-      pub['booktitle'].replace('\"', '\''),
-      pub['pages']
-      )
-
-    try:
-      c.execute(pub_sql)
-    except Error as e:
-      print(e, "|||",  pub)
-
-    insertAuthors(pub)
+  def dropOrphans(author_ids):
+    c.executemany("""DELETE FROM author WHERE id = ? AND NOT EXISTS (
+                       SELECT 1 FROM written_by WHERE author_id = author.id);""",
+                  [(a,) for a in author_ids])
+
+  """
+    Rewrites the buffered publications in one transaction and empties the
+    buffer.
+  """
+  def flush():
+    ids = [recordId(pub) for pub, digest, known in pending]
+    orphans = authorsOf(ids)
+    c.executemany("""DELETE FROM publication WHERE id = ?;""", [(pub_id,) for pub_id in ids])
+    c.executemany("""INSERT OR IGNORE INTO publication VALUES(?, ?, ?, ?, ?);""",
+                  [(pub.id, pub.title, pub.year, pub.booktitle, pub.pages)
+                   for pub, digest, known in pending])
+    accepted = set()
+    for i in range(0, len(ids), 500):
+      chunk = ids[i:i + 500]
+      accepted.update(r[0] for r in c.execute("""SELECT id FROM publication
+        WHERE id IN ({0});""".format(', '.join(['?'] * len(chunk))), chunk))
+    for pub, digest, known in pending:
+      counts['rejected' if recordId(pub) not in accepted else
+             'changed' if known else 'added'] += 1
+    pending[:] = [(pub, digest, known) for pub, digest, known in pending if recordId(pub) in accepted]
+
+    authors = {}
+    names = [AUTHORS[a] for a in set(a for pub, digest, known in pending for a in pub.authors)]
+    for i in range(0, len(names), 500):
+      chunk = names[i:i + 500]
+      for author_id, name in c.execute("""SELECT id, name FROM author
+          WHERE lower(name) IN ({0});""".format(', '.join(['lower(?)'] * len(chunk))), chunk):
+        authors.setdefault(name, author_id)
+    author_rows = []
+    for name in names:
+      if name not in authors:
+        authors[name] = next_ids['author']
+        author_rows.append((authors[name], name))
+        next_ids['author'] += 1
+
+    c.executemany("""INSERT INTO author VALUES(?, ?);""", author_rows)
+    c.executemany("""INSERT OR IGNORE INTO author_token VALUES(?, ?);""",
+                  [(token, author_id) for author_id, name in author_rows
+                   for token in nameTokens(name)])
+    c.executemany("""INSERT OR IGNORE INTO written_by VALUES(?, ?);""",
+                  [(pub.id, authors[AUTHORS[a]]) for pub, digest, known in pending for a in pub.authors])
+    c.executemany("""INSERT INTO publication_digest VALUES(?, ?);""",
+                  [(pub.id, digest) for pub, digest, known in pending])
+    dropOrphans(orphans)
+    conn.commit()
+    del pending[:]
 
   try:
     c = conn.cursor()
-    authors = {'author_id': 0}
-    for index, pub in enumerate(records):
-      insertPublication(pub)
-      if index in [math.floor((f * .1) * len(records)) for f in range(0, 10)]:
-        print("{0}%".format(int(math.ceil( float(index) / float(len(records)) * 100 )))) ,
-      if index == len(records)-1: print('100%')
-    conn.commit()
+    c.execute("""PRAGMA foreign_keys = ON""")
+    if c.execute("""SELECT NOT EXISTS (SELECT 1 FROM author_token)
+                      AND EXISTS (SELECT 1 FROM author);""").fetchone()[0]:
+      c.execute("""CREATE INDEX IF NOT EXISTS author_token_author_id ON author_token(author_id);""")
+      c.executemany("""INSERT OR IGNORE INTO author_token VALUES(?, ?);""",
+                    ((token, author_id) for author_id, name in conn.cursor().execute(
+                      """SELECT id, name FROM author;""") for token in nameTokens(name)))
+      conn.commit()
+    digests = dict(c.execute("""SELECT pub_id, digest FROM publication_digest;"""))
+    if not digests:
+      digests = dict((pub_id, None) for pub_id, in c.execute("""SELECT id FROM publication;"""))
+    next_ids = {'author': c.execute("""SELECT ifnull(max(id), -1) + 1 FROM author;""").fetchone()[0]}
+    seen, pending = set(), []
+    counts = {'added': 0, 'changed': 0, 'rejected': 0}
+    unchanged = 0
+    for pub in records:
+      pub_id = recordId(fixRecord(pub))
+      if pub_id in seen:
+        continue
+      seen.add(pub_id)
+      digest = recordDigest(pub)
+      known = pub_id in digests
+      if known and digests.pop(pub_id) == digest:
+        unchanged += 1
+        continue
+      pending.append((pub, digest, known))
+      if len(pending) == batch_size:
+        flush()
+        print("{0}".format(counts['added'] + counts['changed'])) ,
+    flush()
+
+    removed = list(digests)
+    for i in range(0, len(removed), batch_size):
+      chunk = removed[i:i + batch_size]
+      orphans = authorsOf(chunk)
+      c.executemany("""DELETE FROM publication WHERE id = ?;""", [(pub_id,) for pub_id in chunk])
+      dropOrphans(orphans)
+      conn.commit()
     c.close()
+
+    print("{0} added, {1} changed, {2} removed, {3} unchanged, {4} rejected".format(
+      counts['added'], counts['changed'], len(removed), unchanged, counts['rejected']))
+    return counts['added'], counts['changed'], len(removed), unchanged
   except Error as e:
+    conn.rollback()
     print(e)
 
 
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Creates 'database.db' from a 'pubs.txt' file, or brings an existing 'database.db' up to date with it.")
+  parser.add_argument('path', help="path to 'pubs.txt'")
+  parser.add_argument('-w', '--workers', type=int, default=1,
+      help="number of processes used to parse 'pubs.txt' (default: 1)")
+  parser.add_argument('-m', '--metrics',
+      help="file to write stage and phase latency histograms to, in the "
+           "Prometheus text format if it ends in '.prom' and as JSON otherwise")
+  args = parser.parse_args()
+
+  if args.metrics:
+    from Metrics import Metrics
+    METRICS = Metrics()
+
   start = time.time()
-  if os.path.isfile('database.db'):
-    print("Already created database.\n \
-        Delete 'database.db' to recreate the database.\n \
-        Delete 'pubs.dat' to parse 'pubs.txt' from scratch.")
+  update = os.path.isfile('database.db')
+  if cacheIsFresh('pubs.dat', args.path):
+    print("Already parsed records...these will be used to write to the database.")
+    records = loadRecords('pubs.dat')
   else:
-    if os.path.isfile('pubs.dat'):
-      print("Already parsed records...these will be used to write to the database.")
-      records = timer(cPickle.load, open('pubs.dat', 'rb'))
-    else:
-      print("Parsing records...these will be used to write to the database.")
-      records = timer(parsePublications, sys.argv[1])
-      cPickle.dump(records, open('pubs.dat', 'wb'))
+    print("Parsing records...these will be used to write to the database.")
+    records = cacheRecords(iterPublications(args.path, workers=args.workers), 'pubs.dat', args.path)
 
+  db = timer(connectToDB, 'database.db')
+  timer(createTables, db)
+  if update:
+    if not all(hasTable(db, name) for name in ('written_by_author_id',
+                                               'author_token_author_id',
+                                               'author_lower_name',
+                                               'publication_lower_title',
+                                               'publication_lower_booktitle',
+                                               'publication_year_booktitle')):
+      timer(createIndexes, db)
+    if not hasTable(db, 'publication_fts'):
+      timer(createSearchIndex, db)
+    if not hasTable(db, 'coauthor'):
+      timer(createCoauthorGraph, db)
+    if not hasTable(db, 'relation_count'):
+      timer(createAggregates, db)
+    print("\nUpdating the existing database with the new and changed records...")
+    timer(updateRows, db, records)
+  else:
     print("\nCreating database tables and inserting records...")
-    db = timer(connectToDB, 'database.db')
-    timer(createTables, db)
-    timer(insertRows, db)
-    num_pubs = db.cursor().execute("""SELECT count(*) FROM publication""").fetchone()[0]
-    num_authors = db.cursor().execute("""SELECT count(*) FROM author""").fetchone()[0]
-    num_written_by = db.cursor().execute("""SELECT count(*) FROM written_by""").fetchone()[0]
-    print("\nTotal elapsed time: {0}".format(time.time()-start))
-    print("\nNumber of records:\n\tpublication: {0}\n\tauthor:      {1}\n\twritten_by:  {2}".format(num_pubs, num_authors, num_written_by))
+    timer(insertRows, db, records)
+    timer(createIndexes, db)
+    timer(createSearchIndex, db)
+    timer(createCoauthorGraph, db)
+  counts = dict(db.execute("""SELECT relation, count FROM relation_count;"""))
+  num_pubs, num_authors, num_written_by = [counts.get(r, 0) for r in ['publication', 'author', 'written_by']]
+  print("\nTotal elapsed time: {0}".format(time.time()-start))
+  print("\nNumber of records:\n\tpublication: {0}\n\tauthor:      {1}\n\twritten_by:  {2}".format(num_pubs, num_authors, num_written_by))
+  if METRICS is not None:
+    METRICS.write(args.metrics)
@@ -0,0 +1,218 @@
+import os
+import sys
+import gzip
+import json
+import argparse
+import multiprocessing
+
+import create
+
+"""
+  Queries of exportRecords. Publications are walked in ID order and their
+  authors in one pass over 'written_by' in the same order, in the order the
+  authors were written. {0} is replaced by the year range of a shard.
+"""
+EXPORT_PUBS_SQL = """SELECT id, title, year, booktitle, pages FROM publication
+                     {0} ORDER BY id;"""
+EXPORT_AUTHORS_SQL = """SELECT w.pub_id, a.name FROM written_by as w, author as a
+                        WHERE a.id = w.author_id {0}
+                        ORDER BY w.pub_id, w.rowid;"""
+
+"""
+  Returns the sql condition that limits publications to the years in
+  [first, last], and to those without a year too if 'nulls' is True, along
+  with its parameters. Returns an empty condition when first is None.
+"""
+def yearCondition(first=None, last=None, nulls=False):
+  if first is None:
+    return '', []
+
+  return '(year BETWEEN ? AND ?{0})'.format(' OR year IS NULL' if nulls else ''), [first, last]
+
+"""
+  Generator that reads the database through 'conn' and yields one record
+  dictionary per publication, in ID order, with the same keys as the records
+  parsed from 'pubs.txt' (missing attributes are left out). Only the
+  publications with a year in [first, last], and those without a year if
+  'nulls' is True, are read when a range is given. Both queries are read as
+  they are stepped, so only the current publication and its authors are held
+  in memory; the publications of a year range are put in ID order by SQLite,
+  which spills to a temporary file when they do not fit in its cache.
+"""
+def exportRecords(conn, first=None, last=None, nulls=False):
+  condition, params = yearCondition(first, last, nulls)
+  pubs = conn.cursor()
+  pubs.execute(EXPORT_PUBS_SQL.format('WHERE ' + condition if condition else ''), params)
+  authors = conn.cursor()
+  authors.execute(EXPORT_AUTHORS_SQL.format(
+    'AND w.pub_id IN (SELECT id FROM publication WHERE {0})'.format(condition) if condition else ''),
+    params)
+
+  try:
+    pending = authors.fetchone()
+    for pub_id, title, year, booktitle, pages in pubs:
+      record = {'id': pub_id, 'title': title, 'authors': []}
+      for key, value in [('year', year), ('booktitle', booktitle), ('pages', pages)]:
+        if value is not None:
+          record[key] = value
+      while pending is not None and pending[0] <= pub_id:
+        if pending[0] == pub_id:
+          record['authors'].append(pending[1])
+        pending = authors.fetchone()
+      yield record
+  finally:
+    pubs.close()
+    authors.close()
+
+"""
+  Converts a record into a line of JSON.
+"""
+def toJSONLine(record):
+  return json.dumps(record, sort_keys=True) + '\n'
+
+"""
+  Converts a record into a '<pub>' element laid out as in 'pubs.txt', so the
+  output can be read back by create.py. Values are written as they are stored,
+  without escaping, as 'pubs.txt' does.
+"""
+def toPubXML(record):
+  parts = ['<pub>\n']
+  for tag, key in [('ID', 'id'), ('title', 'title'), ('year', 'year'),
+                   ('booktitle', 'booktitle'), ('pages', 'pages')]:
+    if key in record:
+      parts.extend(['\t<', tag, '>', create.toBytes(record[key]), '</', tag, '>\n'])
+  parts.append('\t<authors>\n')
+  for author in record['authors']:
+    parts.extend(['\t\t<author>', create.toBytes(author), '</author>\n'])
+  parts.append('\t</authors>\n</pub>\n')
+
+  return ''.join(parts)
+
+"""
+  Serializers of the export, keyed by output format.
+"""
+EXPORT_FORMATS = {'jsonl': toJSONLine, 'xml': toPubXML}
+
+"""
+  Returns the path the shard of the years [first, last] of an export to
+  'path' is written to: the year range is put in front of the extensions.
+"""
+def shardPath(path, first, last):
+  base, suffix = path, ''
+  if base.endswith('.gz'):
+    base, suffix = base[:-3], '.gz'
+  base, extension = os.path.splitext(base)
+
+  return '{0}.{1}-{2}{3}{4}'.format(base, first, last, extension, suffix)
+
+"""
+  Splits the years of the publications in the database into at most
+  'shards' contiguous (first, last) ranges holding about the same number of
+  publications each. The counts are read from 'year_count' when the database
+  has it.
+"""
+def yearShards(conn, shards):
+  if create.hasTable(conn, 'year_count'):
+    counts = conn.execute("""SELECT year, count FROM year_count ORDER BY year;""").fetchall()
+  else:
+    counts = conn.execute("""SELECT year, count(*) FROM publication
+                             WHERE year IS NOT NULL GROUP BY year ORDER BY year;""").fetchall()
+  total = sum(count for year, count in counts)
+
+  ranges, first, seen = [], None, 0
+  for year, count in counts:
+    if first is None:
+      first = year
+    seen += count
+    if seen * shards >= total * (len(ranges) + 1):
+      ranges.append((first, year))
+      first = None
+
+  return ranges
+
+"""
+  Exports the publications of the database at 'database' to the file at
+  'path', or to stdout if path is '-', in 'output_format', compressed with
+  gzip if 'compress' is True. Only the years in [first, last] are exported
+  when a range is given. Returns the number of publications written. Takes a
+  single tuple of arguments so it can be the worker function of a shard pool.
+"""
+def exportShard(args):
+  database, path, output_format, compress, first, last, nulls = args
+  serialize = EXPORT_FORMATS[output_format]
+  conn = create.connectToDB(database)
+  conn.execute("""PRAGMA query_only = ON""")
+
+  if path == '-':
+    out = gzip.GzipFile(fileobj=sys.stdout, mode='wb') if compress else sys.stdout
+  else:
+    out = gzip.open(path, 'wb') if compress else open(path, 'wb')
+  count = 0
+  try:
+    for record in exportRecords(conn, first, last, nulls):
+      out.write(serialize(record))
+      count += 1
+  finally:
+    if out is not sys.stdout:
+      out.close()
+    conn.close()
+
+  return count
+
+"""
+  Exports the database at 'database' to 'path' as exportShard does. With
+  more than one shard, the publications are split by year range with
+  yearShards and every range is written to its own file, named by shardPath,
+  by a pool of 'workers' processes; publications without a year go to the
+  first shard. Returns a list of (path, number of publications) pairs.
+"""
+def exportDatabase(database, path, output_format='jsonl', compress=False, shards=1, workers=1):
+  if shards <= 1:
+    return [(path, exportShard((database, path, output_format, compress, None, None, False)))]
+  if path == '-':
+    raise ValueError("Shards cannot be written to stdout")
+
+  conn = create.connectToDB(database)
+  ranges = yearShards(conn, shards)
+  conn.close()
+  if not ranges:
+    return exportDatabase(database, path, output_format, compress)
+  jobs = [(database, shardPath(path, first, last), output_format, compress, first, last, i == 0)
+          for i, (first, last) in enumerate(ranges)]
+  if workers <= 1:
+    counts = [exportShard(job) for job in jobs]
+  else:
+    pool = multiprocessing.Pool(workers)
+    try:
+      counts = pool.map(exportShard, jobs)
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+
+  return [(job[1], count) for job, count in zip(jobs, counts)]
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Exports the publications of 'database.db' as JSON Lines or in the 'pubs.txt' XML layout.")
+  parser.add_argument('output', help="file to write the export to, or '-' for stdout")
+  parser.add_argument('-d', '--database', default='database.db',
+      help="database to export (default: database.db)")
+  parser.add_argument('-f', '--format', choices=sorted(EXPORT_FORMATS), default='jsonl',
+      help="output format (default: jsonl)")
+  parser.add_argument('-z', '--gzip', action='store_true',
+      help="compress the output with gzip")
+  parser.add_argument('-s', '--shards', type=int, default=1,
+      help="number of files to split the export into by year range (default: 1)")
+  parser.add_argument('-w', '--workers', type=int, default=1,
+      help="number of processes writing the shards (default: 1)")
+  args = parser.parse_args()
+
+  if args.shards > 1 and args.output == '-':
+    parser.error("shards cannot be written to stdout")
+  if not os.path.isfile(args.database):
+    raise SystemExit("No database at {0}".format(args.database))
+  for path, count in exportDatabase(args.database, args.output, args.format, args.gzip,
+                                    args.shards, args.workers):
+    if path != '-':
+      print("{0}: {1} publications".format(path, count))
@@ -0,0 +1,172 @@
+import json
+import time
+import bisect
+import threading
+import contextlib
+import collections
+
+"""
+  Upper bounds, in seconds, of the buckets every latency histogram counts
+  observations into. The last bucket, +Inf, is implied.
+"""
+BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+"""
+  Returns the Prometheus label string of a tuple of (name, value) labels.
+"""
+def formatLabels(labels, extra=()):
+  pairs = list(labels) + list(extra)
+  if not pairs:
+    return ''
+
+  return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                        for k, v in pairs) + '}'
+
+"""
+  Returns a query parameter as it is kept in the slow-query log. Numbers,
+  None, and text are kept as they are and bytes are decoded as UTF-8, so that
+  the log can be written as JSON; anything else is kept as its repr.
+"""
+def formatParam(param):
+  if isinstance(param, bytes):
+    return param.decode('utf-8', 'replace')
+  if param is None or isinstance(param, (int, float, type(u''))):
+    return param
+
+  return repr(param)
+
+"""
+  Collects latency histograms, counters, and a log of slow queries for
+  PublicationAPI and create.py. Queries that take at least slow_query_seconds
+  are kept in the slow-query log, which holds the last slow_query_log_size of
+  them. Set slow_query_seconds=None to turn the log off. Every method is safe
+  to call from several threads.
+"""
+class Metrics:
+  def __init__(self, slow_query_seconds=0.1, slow_query_log_size=100):
+    self.slow_query_seconds = slow_query_seconds
+    self.__lock = threading.Lock()
+    self.__histograms = collections.defaultdict(dict)
+    self.__counters = collections.defaultdict(dict)
+    self.__slow_queries = collections.deque(maxlen=slow_query_log_size)
+
+  """
+    Adds an observation of 'seconds' to the histogram 'name' with the
+    keyword arguments as its labels.
+  """
+  def observe(self, name, seconds, **labels):
+    key = tuple(sorted(labels.items()))
+    with self.__lock:
+      histogram = self.__histograms[name].get(key)
+      if histogram is None:
+        histogram = self.__histograms[name][key] = [[0] * (len(BUCKETS) + 1), 0.0]
+      histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+      histogram[1] += seconds
+
+  """
+    Context manager that observes the time spent inside of it in the
+    histogram 'name' with the keyword arguments as its labels.
+  """
+  @contextlib.contextmanager
+  def timer(self, name, **labels):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.observe(name, time.time() - start, **labels)
+
+  """
+    Adds 'amount' to the counter 'name' with the keyword arguments as its
+    labels.
+  """
+  def increment(self, name, amount=1, **labels):
+    key = tuple(sorted(labels.items()))
+    with self.__lock:
+      self.__counters[name][key] = self.__counters[name].get(key, 0) + amount
+
+  """
+    Returns True if a query that took 'seconds' belongs in the slow-query log.
+  """
+  def isSlow(self, seconds):
+    return self.slow_query_seconds is not None and seconds >= self.slow_query_seconds
+
+  """
+    Adds a query to the slow-query log along with its parameters, how long it
+    took, and the steps of its query plan.
+  """
+  def logSlowQuery(self, sql, params, seconds, plan):
+    entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seconds': seconds,
+             'sql': ' '.join(sql.split()), 'params': [formatParam(p) for p in params],
+             'plan': plan}
+    with self.__lock:
+      self.__slow_queries.append(entry)
+
+  """
+    Returns the entries of the slow-query log, oldest first.
+  """
+  def slowQueries(self):
+    with self.__lock:
+      return list(self.__slow_queries)
+
+  """
+    Returns a dictionary of every histogram, counter, and slow query. Each
+    histogram series holds its labels, its cumulative bucket counts keyed by
+    upper bound, and the count and sum of its observations.
+  """
+  def snapshot(self):
+    with self.__lock:
+      histograms = {}
+      for name, series in self.__histograms.items():
+        histograms[name] = []
+        for labels, (counts, total) in sorted(series.items()):
+          cumulative, buckets = 0, collections.OrderedDict()
+          for bound, count in zip([str(b) for b in BUCKETS] + ['+Inf'], counts):
+            cumulative += count
+            buckets[bound] = cumulative
+          histograms[name].append({'labels': dict(labels), 'buckets': buckets,
+                                   'count': cumulative, 'sum': total})
+      counters = {}
+      for name, series in self.__counters.items():
+        counters[name] = [{'labels': dict(labels), 'value': value}
+                          for labels, value in sorted(series.items())]
+
+      return {'histograms': histograms, 'counters': counters,
+              'slow_queries': list(self.__slow_queries)}
+
+  """
+    Returns the snapshot as a JSON string.
+  """
+  def toJSON(self):
+    return json.dumps(self.snapshot(), indent=2)
+
+  """
+    Returns the histograms and counters in the Prometheus text exposition
+    format. Counters are exported with a '_total' suffix.
+  """
+  def toPrometheus(self):
+    snapshot = self.snapshot()
+    lines = []
+    for name in sorted(snapshot['histograms']):
+      lines.append('# TYPE {0} histogram'.format(name))
+      for series in snapshot['histograms'][name]:
+        labels = sorted(series['labels'].items())
+        for bound, count in series['buckets'].items():
+          lines.append('{0}_bucket{1} {2}'.format(name, formatLabels(labels, [('le', bound)]), count))
+        lines.append('{0}_sum{1} {2}'.format(name, formatLabels(labels), series['sum']))
+        lines.append('{0}_count{1} {2}'.format(name, formatLabels(labels), series['count']))
+    for name in sorted(snapshot['counters']):
+      lines.append('# TYPE {0}_total counter'.format(name))
+      for series in snapshot['counters'][name]:
+        lines.append('{0}_total{1} {2}'.format(name, formatLabels(sorted(series['labels'].items())),
+                                                series['value']))
+
+    return '\n'.join(lines) + '\n'
+
+  """
+    Writes the snapshot to the file at 'path', in the Prometheus text format
+    if the path ends in '.prom' and as JSON otherwise.
+  """
+  def write(self, path):
+    with open(path, 'w') as f:
+      f.write(self.toPrometheus() if path.endswith('.prom') else self.toJSON())
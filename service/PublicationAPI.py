@@ -1,115 +1,789 @@
-import sqlite3
+import re
+import os
+import json
 import time
+import array
+import base64
+import sqlite3
+import weakref
+import threading
+import functools
+import contextlib
+import collections
 from sqlite3 import Error
 
+"""
+  Returns value as a unicode string if it is UTF-8 encoded bytes, so that it
+  can be bound as an sqlite3 parameter.
+"""
+def toText(value):
+  return value.decode('utf-8') if isinstance(value, bytes) else value
+
+"""
+  Returns the set of normalized tokens of an author name as they are stored
+  in 'author_token': the lowercase parts of the name split on everything that
+  is not a letter or digit, so that an initial such as 'C.' becomes the token
+  'c'. create.py fills 'author_token' with this function too. Bytes that are
+  not UTF-8 are replaced rather than raising, so such a name still gets the
+  tokens of its other parts.
+"""
+def nameTokens(name):
+  if isinstance(name, bytes):
+    name = name.decode('utf-8', 'replace')
+
+  return set(re.findall(r'\w+', name.lower(), re.UNICODE))
+
+"""
+  Converts a page row (id, title, year, booktitle) and its list of authors
+  into a JSON-ready dictionary. Rows of sorted_order='name' pages also hold the
+  author name and are converted with that single name as 'authors'.
+"""
+def toJSON(row, authors):
+  if len(row) > 4:
+    return {'title': row[1], 'authors': row[4], 'year': row[2],
+            'journal': row[3] if row[3] else ""}
+
+  return {'title': row[1], 'authors': authors, 'year': row[2], 'journal': row[3]}
+
+"""
+  Converts a page row and its list of authors into a '<pub>' XML string.
+"""
+def toXML(row, authors):
+  parts = ['<pub>\n\t<title>', row[1], '</title>\n\t<authors>']
+  for author in ([row[4]] if len(row) > 4 else authors):
+    parts.extend(['\n\t\t<author>', author, '</author>'])
+  parts.extend(['\n\t</authors>\n\t<year>', str(row[2]), '</year>\n\t<booktitle>',
+                row[3] or '', '</booktitle>\n</pub>'])
+
+  return ''.join(parts)
+
+"""
+  Serializers used by queryPublication, keyed by output_format.
+"""
+SERIALIZERS = {'JSON': toJSON, 'XML': toXML}
+
+"""
+  Serializers used by streamPublication, keyed by output_format. Each one
+  returns a newline-terminated chunk: a JSON line or a '<pub>' element.
+"""
+STREAM_SERIALIZERS = {
+  'JSON': lambda row, authors: json.dumps(toJSON(row, authors)) + '\n',
+  'XML': lambda row, authors: toXML(row, authors) + '\n'
+}
+
+"""
+  Queries aggregateCounts runs to list a summary table, keyed by its 'by'
+  argument.
+"""
+AGGREGATE_COUNTS = {
+  'relation': """SELECT relation, count FROM relation_count ORDER BY relation;""",
+  'year': """SELECT year, count FROM year_count ORDER BY year;""",
+  'journal': """SELECT booktitle, count FROM venue_count ORDER BY booktitle;""",
+  'journal_year': """SELECT booktitle, year, count FROM venue_year_count ORDER BY booktitle, year;""",
+  'author': """SELECT a.name, c.count FROM author_count as c, author as a
+               WHERE a.id = c.author_id ORDER BY a.name;"""
+}
+
+"""
+  Returns the number of parameters a list of count values is padded to: the
+  next power of two from 8. Padding lists of IDs and names with NULLs keeps
+  the statements that bind them to a handful of shapes.
+"""
+def paddedSize(count):
+  size = 8
+  while size < count:
+    size *= 2
+
+  return size
+
+"""
+  Connection that remembers the statement shapes it has prepared, so that
+  PublicationAPI can count how often each shape is compiled.
+"""
+class StatementConnection(sqlite3.Connection):
+  def __init__(self, *args, **kwargs):
+    sqlite3.Connection.__init__(self, *args, **kwargs)
+    self.prepared = set()
+
+"""
+  Object kept in the local state of a thread that reads through its own
+  connection. A thread's local state is released when the thread exits, so a
+  weak reference to its marker tells PublicationAPI when to close the
+  thread's connection.
+"""
+class ThreadMarker(object):
+  pass
+
+"""
+  Decorator that observes the latency of every call of a PublicationAPI method
+  in the 'publication_api_method_seconds' histogram when the API has metrics.
+"""
+def instrumented(fn):
+  @functools.wraps(fn)
+  def method(self, *args, **kwargs):
+    if self.metrics is None:
+      return fn(self, *args, **kwargs)
+    with self.metrics.timer('publication_api_method_seconds', method=fn.__name__):
+      return fn(self, *args, **kwargs)
+
+  return method
+
 class PublicationAPI:
   __conn = None
   __next_pub_id = None
   __next_author_id = 0
-  __authors = {}
+  __authors = None
+  __fts = False
+  __tokens = False
+  __coauthors = False
+  __aggregates = False
+  __graph = None
+  __pooled = False
+  __lazy = False
+  __author_memo = None
+  __author_memo_size = 10000
+  __generation = 0
+  __cache = None
+  __cache_size = 0
+  __batch_size = 500
+  __statement_cache_size = 512
+  __snapshot = None
+  __snapshot_check_seconds = 1.0
+  __snapshot_mmap_size = 1 << 30
+  __snapshot_cache_kib = 262144
   __current_year = time.strftime("%Y")
+  metrics = None
 
   """
     Connects to the database named in the parameter, fetches the maximum ID in
-    order to set __next_pub_id, and turns on foreign key contraints.
+    order to set __next_pub_id, and turns on foreign key contraints. The
+    connection is in autocommit mode; batches of writes open their own
+    transactions.
+
+    If pooled=True, the API may be shared by many threads: every thread reads
+    through its own connection, writes are serialized through a single writer
+    connection, the database is switched to WAL journal mode so that readers
+    and the writer do not block each other, and new IDs are allocated by the
+    database inside each write transaction instead of by Python counters.
+
+    If cache_size is greater than 0, up to that many queryPublication results
+    are kept in an LRU cache that every write invalidates.
+
+    Every statement is parameterized, so each method runs one of a small set
+    of statement shapes that every connection prepares once and keeps in a
+    statement cache of __statement_cache_size entries.
+
+    If metrics is a Metrics object, the API records the latency of every
+    method call and of its phases (validating records, inserting them,
+    executing sql, fetching rows, and serializing results), counts the rows
+    its queries go through and return and the errors it prints, and logs
+    queries slower than metrics.slow_query_seconds along with their query
+    plans.
+
+    If lazy=True, the author relation is not loaded: the maximum IDs are read
+    through the primary key indexes and author names are resolved when they
+    are inserted, through the lower(name) index, with the most recently used
+    names kept in a bounded memo. Construction time and memory then stay the
+    same however many authors there are.
+
+    If snapshot is 'memory' or 'mmap', the API only serves reads and every
+    write method fails with an error. With 'memory', the database is copied
+    into an in-memory database through the sqlite3 backup API (Python 3.7 and
+    later; older versions fall back to 'mmap'), which every thread reads
+    through its own connection. With 'mmap', every thread reads the file
+    through its own read-only connection with a large memory map and page
+    cache. Once per __snapshot_check_seconds a read checks whether the file
+    has changed, and if it has a fresh snapshot is swapped in and the result
+    cache is invalidated; see refreshSnapshot.
   """
-  def __init__(self, database):
+  def __init__(self, database, pooled=False, cache_size=0, lazy=False, metrics=None,
+      snapshot=None):
+    self.__database = database
+    self.__snapshot = snapshot
+    if snapshot == 'memory' and not hasattr(sqlite3.Connection, 'backup'):
+      print("In-memory snapshots need the sqlite3 backup API; using snapshot='mmap'")
+      self.__snapshot = 'mmap'
+    self.__snapshot_lock = threading.Lock()
+    self.__snapshot_state = (0, None)
+    self.__snapshot_owner = None
+    self.__snapshot_stamp = None
+    self.__snapshot_next_check = 0
+    self.metrics = metrics
+    self.__pooled = pooled
+    self.__lazy = lazy
+    self.__author_memo = collections.OrderedDict()
+    self.__cache_size = cache_size
+    self.__cache = collections.OrderedDict()
+    self.__cache_lock = threading.Lock()
+    self.__cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+    self.__authors = {}
+    self.__write_lock = threading.Lock()
+    self.__readers_lock = threading.Lock()
+    self.__readers = {}
+    self.__local = threading.local()
+    self.__statements = {}
+    self.__statements_lock = threading.Lock()
     try:
-      self.__conn = sqlite3.connect(database)
+      self.__conn = sqlite3.connect(database, check_same_thread=not (pooled or snapshot),
+                                    isolation_level=None, factory=StatementConnection,
+                                    cached_statements=self.__statement_cache_size)
       cursor = self.__conn.cursor()
-      self.__next_pub_id = cursor.execute("""SELECT max(id) FROM publication;
-                                          """).fetchone()[0] + 1
-      self.__authors = {k[1]:k[0] for k in cursor.execute("""SELECT id, name FROM author;
-                                      """).fetchall()}
-      self.__next_author_id = max(self.__authors.values()) + 1
+      if snapshot:
+        cursor.execute("""PRAGMA query_only = ON""")
+      elif pooled:
+        cursor.execute("""PRAGMA journal_mode = WAL""").fetchall()
+        cursor.execute("""PRAGMA synchronous = NORMAL""")
+      elif lazy:
+        self.__next_pub_id, self.__next_author_id = cursor.execute(
+          """SELECT (SELECT ifnull(max(id), -1) + 1 FROM publication),
+                    (SELECT ifnull(max(id), -1) + 1 FROM author);""").fetchone()
+      else:
+        self.__next_pub_id = cursor.execute("""SELECT max(id) FROM publication;
+                                            """).fetchone()[0] + 1
+        self.__loadAuthors(cursor)
+        self.__next_author_id = cursor.execute("""SELECT max(id) FROM author;
+                                               """).fetchone()[0] + 1
+      self.__fts = cursor.execute("""SELECT count(*) FROM sqlite_master
+                                     WHERE name = 'publication_fts';""").fetchone()[0] > 0
+      self.__tokens = cursor.execute("""SELECT count(*) FROM sqlite_master
+                                        WHERE name = 'author_token';""").fetchone()[0] > 0
+      self.__coauthors = cursor.execute("""SELECT count(*) FROM sqlite_master
+                                           WHERE name = 'coauthor';""").fetchone()[0] > 0
+      self.__aggregates = cursor.execute("""SELECT count(*) FROM sqlite_master
+                                            WHERE name = 'relation_count';""").fetchone()[0] > 0
       cursor.execute("""PRAGMA foreign_keys = ON""").close()
     except Error as e:
-      print(e)
+      self.__error(e)
+    if self.__snapshot:
+      self.refreshSnapshot(force=True)
 
   """
-    Replaces \" characters with \' for every attribute in the input list
-    record. Creates an INSERT sql string for the publication relation and
-    executes it. List record must be of the form:
-    [title, year, journal, pages, authors] where 'authors' is a list of authors.
+    Loads the ID of every author name into __authors, keyed by the lowercase
+    name. The lowest ID is kept for names that differ only in case.
   """
-  def insertPublication(self, record):
-    if record[1] > self.__current_year:
+  def __loadAuthors(self, cursor):
+    self.__authors = {}
+    for author_id, name in cursor.execute("""SELECT id, name FROM author ORDER BY id;"""):
+      self.__authors.setdefault(name.lower(), author_id)
+
+  """
+    Prints an error that is not raised to the caller and counts it in the
+    'publication_api_errors' counter.
+  """
+  def __error(self, e):
+    print(e)
+    if self.metrics is not None:
+      self.metrics.increment('publication_api_errors', error=type(e).__name__)
+
+  """
+    Adds the sql and query plan of a query that took 'seconds' to the
+    slow-query log if it is slow enough.
+  """
+  def __logSlowQuery(self, conn, sql, params, seconds):
+    if not self.metrics.isSlow(seconds):
+      return
+    try:
+      plan = [step[-1] for step in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+    except Error as e:
+      plan = [str(e)]
+    self.metrics.logSlowQuery(sql, params, seconds, plan)
+
+  """
+    Returns the (size, mtime) pairs of the database file and of its
+    write-ahead log, which change whenever a write reaches the file.
+  """
+  def __fileStamp(self):
+    stamp = []
+    for path in [self.__database, self.__database + '-wal']:
+      try:
+        info = os.stat(path)
+        stamp.append((info.st_size, info.st_mtime))
+      except OSError:
+        stamp.append(None)
+
+    return stamp
+
+  """
+    Swaps in a fresh snapshot of the database if the file has changed since
+    the current one was taken, or if force=True, and invalidates the result
+    cache and the coauthor graph. With snapshot='memory' the file is copied
+    into a new in-memory database that threads move to on their next read,
+    while reads already under way finish on the old copy. With
+    snapshot='mmap' the read connections already see the new contents, so
+    only the caches are invalidated. Returns True if a snapshot was swapped
+    in, and False if nothing changed or another thread is already swapping.
+  """
+  def refreshSnapshot(self, force=False):
+    if not self.__snapshot or not self.__snapshot_lock.acquire(False):
+      return False
+
+    try:
+      self.__snapshot_next_check = time.time() + self.__snapshot_check_seconds
+      stamp = self.__fileStamp()
+      if stamp == self.__snapshot_stamp and not force:
+        return False
+
+      if self.__snapshot == 'memory':
+        version = self.__snapshot_state[0] + 1
+        uri = 'file:publication_snapshot_{0}_{1}?mode=memory&cache=shared'.format(id(self), version)
+        owner = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        source = sqlite3.connect(self.__database)
+        try:
+          source.backup(owner)
+        finally:
+          source.close()
+        old, self.__snapshot_owner = self.__snapshot_owner, owner
+        self.__snapshot_state = (version, uri)
+        if old is not None:
+          old.close()
+      self.__snapshot_stamp = stamp
+      with self.__cache_lock:
+        self.__generation += 1
+      if self.metrics is not None:
+        self.metrics.increment('publication_api_snapshot_swaps')
+      return True
+    except Error as e:
+      self.__error(e)
+      return False
+    finally:
+      self.__snapshot_lock.release()
+
+  """
+    Refreshes the snapshot if __snapshot_check_seconds have passed since the
+    file was last checked. Called before the result cache or the coauthor
+    graph is consulted and whenever a snapshot connection is handed out.
+  """
+  def __checkSnapshot(self):
+    if self.__snapshot and time.time() >= self.__snapshot_next_check:
+      self.refreshSnapshot()
+
+  """
+    Returns the calling thread's read-only connection to the current
+    snapshot, opening it on first use and again after a swap.
+  """
+  def __snapshotReader(self):
+    self.__checkSnapshot()
+
+    version, uri = self.__snapshot_state
+    conn = getattr(self.__local, 'conn', None)
+    if conn is not None and self.__local.version != version:
+      self.__releaseReader(self.__local.ref)
+      conn = None
+    if conn is None:
+      if uri:
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                               factory=StatementConnection,
+                               cached_statements=self.__statement_cache_size)
+      else:
+        conn = sqlite3.connect(self.__database, check_same_thread=False,
+                               factory=StatementConnection,
+                               cached_statements=self.__statement_cache_size)
+        conn.execute("""PRAGMA mmap_size = {0}""".format(self.__snapshot_mmap_size)).fetchall()
+        conn.execute("""PRAGMA cache_size = -{0}""".format(self.__snapshot_cache_kib))
+      conn.execute("""PRAGMA query_only = ON""")
+      self.__trackReader(conn)
+      self.__local.version = version
+
+    return conn
+
+  """
+    Returns the connection reads are made through: the calling thread's own
+    read-only connection if pooled=True, which is opened on first use, or to
+    the current snapshot in snapshot mode.
+  """
+  def __reader(self):
+    if self.__snapshot:
+      return self.__snapshotReader()
+    if not self.__pooled:
+      return self.__conn
+
+    conn = getattr(self.__local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.__database, check_same_thread=False,
+                             factory=StatementConnection,
+                             cached_statements=self.__statement_cache_size)
+      conn.execute("""PRAGMA query_only = ON""")
+      self.__trackReader(conn)
+
+    return conn
+
+  """
+    Makes conn the calling thread's read connection and tracks it by a weak
+    reference to a marker in the thread's local state, so that it is closed
+    by __releaseReader once the thread exits, or by close().
+  """
+  def __trackReader(self, conn):
+    marker = ThreadMarker()
+    ref = weakref.ref(marker, self.__releaseReader)
+    with self.__readers_lock:
+      self.__readers[ref] = conn
+    self.__local.conn, self.__local.marker, self.__local.ref = conn, marker, ref
+
+  """
+    Closes the read connection tracked by the weak reference ref, if it is
+    still open. Called when the marker of its thread is released.
+  """
+  def __releaseReader(self, ref):
+    with self.__readers_lock:
+      conn = self.__readers.pop(ref, None)
+    if conn is not None:
+      conn.close()
+
+  """
+    Context manager that holds the write lock and gives the writer connection,
+    so only one thread writes at a time. Every write bumps the generation
+    counter, which invalidates the results cached before it. Raises an error
+    in snapshot mode, which serves reads only.
+  """
+  @contextlib.contextmanager
+  def __writer(self):
+    if self.__snapshot:
+      raise Error("attempt to write a read-only snapshot")
+    with self.__write_lock:
+      try:
+        yield self.__conn
+      finally:
+        with self.__cache_lock:
+          self.__generation += 1
+
+  """
+    Runs sql with the parameters params through cursor, or with every
+    sequence of parameters in params if many=True, and returns the cursor.
+    The run is counted against the statement's shape, which is counted as
+    prepared the first time the cursor's connection runs it; after that it is
+    reused from the connection's statement cache. With metrics, the time the
+    statement takes to execute is observed and, unless slow=False, the
+    statement is checked against the slow-query threshold.
+  """
+  def __execute(self, cursor, sql, params=(), many=False, slow=True):
+    prepared = cursor.connection.prepared
+    with self.__statements_lock:
+      stats = self.__statements.setdefault(sql, {'prepares': 0, 'executes': 0})
+      if sql not in prepared:
+        prepared.add(sql)
+        stats['prepares'] += 1
+      stats['executes'] += 1
+
+    if self.metrics is None:
+      return cursor.executemany(sql, params) if many else cursor.execute(sql, params)
+
+    start = time.time()
+    result = cursor.executemany(sql, params) if many else cursor.execute(sql, params)
+    seconds = time.time() - start
+    self.metrics.observe('publication_api_phase_seconds', seconds, phase='execute')
+    if slow and not many:
+      self.__logSlowQuery(cursor.connection, sql, params, seconds)
+
+    return result
+
+  """
+    Returns a dictionary of the prepare and execute counts of every statement
+    shape run so far, keyed by its sql with whitespace collapsed.
+  """
+  def statementStats(self):
+    with self.__statements_lock:
+      return dict((' '.join(sql.split()), dict(stats))
+                  for sql, stats in self.__statements.items())
+
+  """
+    Closes the writer connection, every thread's read connection, and the
+    in-memory snapshot.
+  """
+  def close(self):
+    with self.__readers_lock:
+      for conn in self.__readers.values():
+        conn.close()
+      self.__readers.clear()
+    with self.__snapshot_lock:
+      if self.__snapshot_owner is not None:
+        self.__snapshot_owner.close()
+        self.__snapshot_owner = None
+    with self.__write_lock:
+      self.__conn.close()
+
+  """
+    Returns the reason a [title, year, journal, pages, authors] record may not
+    be inserted, or None if it may be.
+  """
+  def __checkRecord(self, record):
+    if len(record) != 5 or not record[0]:
+      return "Publications must be of the form [title, year, journal, pages, authors]!"
+    try:
+      year = int(record[1])
+    except (TypeError, ValueError):
+      return "Publications must have a numeric year!"
+    if year > int(self.__current_year):
       return "You may not insert publications that have yet to be published!"
-    elif record[1] < 1835:
+    elif year < 1835:
       return "There were no computer engineering papers published prior to 1835!"
 
-    pub = [str(r).replace('\"', '\'') for r in record[:-1]]
-    authors = record[-1]
-    sql = """INSERT INTO publication VALUES({0}, "{1}", {2}, "{3}", "{4}");""".format(self.__next_pub_id, *pub)
+  """
+    Returns a dictionary of the IDs of the author names in the list names that
+    are already in the 'author' relation, keyed by the lowercase name, looked
+    up through the lower(name) index in chunks of __batch_size names.
+  """
+  def __findAuthors(self, cursor, names):
+    found = {}
+    for i in range(0, len(names), self.__batch_size):
+      chunk = names[i:i + self.__batch_size]
+      size = paddedSize(len(chunk))
+      sql = """SELECT id, name FROM author WHERE lower(name) IN ({0});""".format(
+        ', '.join(['lower(?)'] * size))
+      for author_id, name in self.__execute(cursor, sql, chunk + [None] * (size - len(chunk))):
+        found.setdefault(name.lower(), author_id)
 
-    for a in authors:
-      if a not in self.__authors:
-        self.__authors[a] = self.__next_author_id
-        sql += """INSERT INTO author VALUES({0}, '{1}');""".format(self.__next_author_id, a)
-        self.__next_author_id += 1
-        sql += """INSERT INTO written_by VALUES({0}, {1});""".format(self.__next_pub_id, self.__next_author_id-1)
+    return found
+
+  """
+    Adds a dictionary of lowercase author names and IDs to the bounded memo of
+    lazy mode, dropping the least recently used names once it is full.
+  """
+  def __rememberAuthors(self, authors):
+    for name, author_id in authors.items():
+      self.__author_memo.pop(name, None)
+      self.__author_memo[name] = author_id
+    while len(self.__author_memo) > self.__author_memo_size:
+      self.__author_memo.popitem(last=False)
+
+  """
+    Inserts a batch of records of the form [title, year, journal, pages,
+    authors] in a single transaction. Author names are matched with the
+    authors already in the database ignoring case, in every mode, and the IDs
+    of all new authors in the batch are allocated at once. The rows are
+    inserted with executemany. Records that fail validation are skipped
+    without aborting the batch; returns a list of (index, reason) pairs for
+    them. If the database rejects the batch, none of it is inserted and every
+    record of the batch that passed validation is also returned, with the
+    database's error as its reason.
+  """
+  @instrumented
+  def insertPublications(self, records):
+    start = time.time()
+    failures, valid, indexes = [], [], []
+    for index, record in enumerate(records):
+      error = self.__checkRecord(record)
+      if error:
+        failures.append((index, error))
       else:
-        sql += """INSERT INTO written_by VALUES({0}, {1});""".format(self.__next_pub_id, self.__authors[a])
+        valid.append([toText(r) for r in record[:-1]] + [[toText(a) for a in record[-1]]])
+        indexes.append(index)
+    if self.metrics is not None:
+      self.metrics.observe('publication_api_phase_seconds', time.time() - start, phase='validate')
+      start = time.time()
 
+    error = None
     try:
-      self.__conn.cursor().executescript(sql).close()
-      self.__conn.commit()
-      self.__next_pub_id += 1
+      with self.__writer() as conn:
+        cursor = conn.cursor()
+        new_authors = []
+        try:
+          self.__execute(cursor, """BEGIN IMMEDIATE""")
+          if self.__pooled:
+            next_pub_id, next_author_id = self.__execute(cursor,
+              """SELECT (SELECT ifnull(max(id), -1) + 1 FROM publication),
+                        (SELECT ifnull(max(id), -1) + 1 FROM author);""").fetchone()
+            authors = self.__findAuthors(cursor, list(set(a for r in valid for a in r[-1])))
+          elif self.__lazy:
+            next_pub_id, next_author_id = self.__next_pub_id, self.__next_author_id
+            names = list(set(a for r in valid for a in r[-1]))
+            authors = dict((a.lower(), self.__author_memo[a.lower()]) for a in names
+                           if a.lower() in self.__author_memo)
+            authors.update(self.__findAuthors(cursor, [a for a in names if a.lower() not in authors]))
+          else:
+            next_pub_id, next_author_id = self.__next_pub_id, self.__next_author_id
+            authors = self.__authors
+
+          pubs, written_by = [], []
+          for title, year, journal, pages, names in valid:
+            pubs.append((next_pub_id, title, int(year), journal, pages))
+            for a in names:
+              if a.lower() not in authors:
+                authors[a.lower()] = next_author_id
+                new_authors.append((next_author_id, a))
+                next_author_id += 1
+              written_by.append((next_pub_id, authors[a.lower()]))
+            next_pub_id += 1
+
+          self.__execute(cursor, """INSERT INTO publication VALUES(?, ?, ?, ?, ?);""", pubs, True)
+          self.__execute(cursor, """INSERT INTO author VALUES(?, ?);""", new_authors, True)
+          if self.__tokens:
+            self.__execute(cursor, """INSERT OR IGNORE INTO author_token VALUES(?, ?);""",
+                           [(t, author_id) for author_id, a in new_authors for t in nameTokens(a)], True)
+          self.__execute(cursor, """INSERT OR IGNORE INTO written_by VALUES(?, ?);""", written_by, True)
+          self.__execute(cursor, """COMMIT""")
+          if not self.__pooled:
+            self.__next_pub_id, self.__next_author_id = next_pub_id, next_author_id
+          if self.__lazy:
+            self.__rememberAuthors(authors)
+        except Error as e:
+          cursor.execute("""ROLLBACK""")
+          if not (self.__pooled or self.__lazy):
+            self.__loadAuthors(cursor)
+          self.__author_memo.clear()
+          error = e
+          self.__error(e)
+        cursor.close()
     except Error as e:
-      print(e)
+      error = e
+      self.__error(e)
+    if self.metrics is not None:
+      self.metrics.observe('publication_api_phase_seconds', time.time() - start, phase='insert')
+    if error is not None:
+      failures = sorted(failures + [(index, str(error)) for index in indexes])
+
+    return failures
+
+  """
+    Inserts a publication, adding unseen authors into the 'author' relation
+    and connecting them to it in 'written_by'. List record must be of the form:
+    [title, year, journal, pages, authors] where 'authors' is a list of authors.
+    Returns the reason the record was rejected, by validation or by the
+    database, if it was.
+  """
+  @instrumented
+  def insertPublication(self, record):
+    failures = self.insertPublications([record])
+    if failures:
+      return failures[0][1]
+
+  """
+    Returns the sql string that selects the IDs of the authors matching every
+    word of the name 'author' through the 'author_token' index, and its
+    parameters, or None if the name has no words. The words are split as
+    nameTokens splits stored names, and a word matches the tokens it is a
+    prefix of, so an initial matches every name part starting with it, but a
+    longer word never matches a stored initial. Each word has to match a
+    different name part, so the 'a' of 'Smoke Author A' does not match the
+    'author' of 'Smoke Author B': a word that starts other words of the name
+    needs as many name parts starting with it as there are such words.
+  """
+  def __authorMatchSQL(self, author):
+    selects, params = [], []
+    words = sorted(nameTokens(author or ''))
+    for word in words:
+      needed = len([other for other in words if other.startswith(word)])
+      if needed > 1:
+        selects.append("""SELECT author_id FROM author_token
+                          WHERE token >= ? AND token < ?
+                          GROUP BY author_id HAVING count(*) >= ?""")
+        params.extend([word, word + u'\uffff', needed])
+      else:
+        selects.append("""SELECT author_id FROM author_token
+                          WHERE token >= ? AND token < ?""")
+        params.extend([word, word + u'\uffff'])
+
+    return (' INTERSECT '.join(selects), params) if selects else None
+
+  """
+    Returns the DELETE sql string used by deleteAuthor and its parameters.
+    Authors are matched through 'author_token' when exact=False and the
+    database has it.
+  """
+  def __deleteAuthorSQL(self, author, exact=True):
+    author = toText(author).lower()
+    if exact:
+      return """DELETE FROM author WHERE lower(name) = ?;""", [author]
+    if self.__tokens:
+      match = self.__authorMatchSQL(author) or ("""SELECT NULL""", [])
+      return """DELETE FROM author WHERE id IN ({0});""".format(match[0]), match[1]
+
+    words = author.split()
+    if len(words) > 2:
+      words = [words[0], words[1].rstrip('.'), words[2]] # Removes the '.' from an initial
+
+    return """DELETE FROM author WHERE lower(name) LIKE ?;""", ['%' + '%'.join(words) + '%']
 
   """
     Deletes authors. If exact=True, only deletes exact name matches. If
-    exact=False, deletes all authors where the author's name has any of the
-    paramter name's substrings in it.
+    exact=False, deletes all authors whose name has a part starting with each
+    word of the parameter name, in any order, so 'D. Anastasiu' and 'David
+    Anastasiu' both delete 'David C. Anastasiu'. Each word has to match a
+    different part of the name.
   """
+  @instrumented
   def deleteAuthor(self, author, exact=True):
-    if exact:
-      sql = """DELETE FROM author WHERE lower(name)= '{0}'""".format(author.lower())
-    else:
-      if len(author.split()) == 1:
-        sql = """DELETE FROM author WHERE lower(name) LIKE '%{0}%'""".format(author.lower())
-      elif len(author.split()) == 2:
-        sql = """DELETE FROM author WHERE lower(name) LIKE '%{0}%{1}%'""".format(*[a.lower() for a in author.split()])
-      else:
-        author = author.split()
-        author[1] = author[1][0] # Removes the '.' from an initial
-        sql = """DELETE FROM author WHERE name LIKE '%{0}%{1}%{2}%'""".format(*[a.lower() for a in author])
+    sql, params = self.__deleteAuthorSQL(author, exact)
 
     try:
-      self.__conn.cursor().execute(sql).close()
-      self.__conn.commit()
+      with self.__writer() as conn:
+        self.__execute(conn.cursor(), sql, params).close()
+        conn.commit()
+        self.__author_memo.clear()
     except Error as e:
-      print(e)
+      self.__error(e)
+
+  """
+    Returns the DELETE sql string used by deletePublication and its parameters.
+  """
+  def __deletePublicationSQL(self, record):
+    return """DELETE FROM publication WHERE lower(title) = ?
+              AND year = ? AND lower(booktitle) = ?;""", \
+      [toText(r).lower() if type(r) is not int else r for r in record[:3]]
 
   """
     Deletes all publications matching the title, year, and journal name in the
     parameter list. List record must be of the form: [title, year, journal].
   """
+  @instrumented
   def deletePublication(self, record):
-    sql = """DELETE FROM publication WHERE id in (
-             SELECT p.id FROM publication as p, written_by as w, author as a
-             WHERE p.id = w.pub_id AND w.author_id = a.id AND lower(p.title) = '{0}'
-             AND p.year = {1} AND lower(p.booktitle) = '{2}')""".format(
-               *[r.lower() if type(r) is not int else r for r in record])
+    sql, params = self.__deletePublicationSQL(record)
 
     try:
-      self.__conn.cursor().execute(sql).close()
-      self.__conn.commit()
+      with self.__writer() as conn:
+        self.__execute(conn.cursor(), sql, params).close()
+        conn.commit()
     except Error as e:
-      print(e)
+      self.__error(e)
+
+  """
+    Returns the UPDATE sql string used by updateAuthor and its parameters.
+  """
+  def __updateAuthorSQL(self, old_name, new_name):
+    return """UPDATE author SET name = ? WHERE lower(name) = ?;""", \
+      [toText(new_name), toText(old_name).lower()]
 
   """
-    Updates the names to new_name for authors with a name matching old_name.
+    Updates the names to new_name for authors with a name matching old_name,
+    along with their tokens in 'author_token'.
   """
+  @instrumented
   def updateAuthor(self, old_name, new_name):
-    sql = """UPDATE author SET name = '{0}' WHERE lower(name) = '{1}';""".format(new_name, old_name.lower())
+    sql, params = self.__updateAuthorSQL(old_name, new_name)
 
     try:
-      self.__conn.cursor().execute(sql).close()
-      self.__conn.commit()
+      with self.__writer() as conn:
+        cursor = conn.cursor()
+        try:
+          self.__execute(cursor, """BEGIN IMMEDIATE""")
+          if self.__tokens:
+            ids = [r[0] for r in self.__execute(cursor,
+              """SELECT id FROM author WHERE lower(name) = ?;""", params[1:]).fetchall()]
+          self.__execute(cursor, sql, params)
+          if self.__tokens:
+            self.__execute(cursor, """DELETE FROM author_token WHERE author_id = ?;""",
+                           [(i,) for i in ids], True)
+            self.__execute(cursor, """INSERT OR IGNORE INTO author_token VALUES(?, ?);""",
+                           [(t, i) for i in ids for t in nameTokens(new_name)], True)
+          self.__execute(cursor, """COMMIT""")
+        except Error:
+          cursor.execute("""ROLLBACK""")
+          raise
+        finally:
+          cursor.close()
+        self.__author_memo.clear()
     except Error as e:
-      print(e)
+      self.__error(e)
+
+  """
+    Returns the UPDATE sql string used by updatePublication and its
+    parameters. Only the columns with new values are set.
+  """
+  def __updatePublicationSQL(self, old, new):
+    columns = [c for c, value in zip(['title', 'year', 'booktitle'], new) if value]
+    params = [toText(value) for value in new[:3] if value]
+    return """UPDATE publication SET {0} WHERE lower(title) = ? and year = ? and lower(booktitle) = ?;""".format(
+      ', '.join(c + ' = ?' for c in columns)), \
+      params + [toText(old[0]).lower(), old[1], toText(old[2]).lower()]
 
   """
     Updates the journal, title, or year of a publication by matching the title,
@@ -118,142 +792,666 @@ class PublicationAPI:
     [title, year, journal]. Use None or empty strings for values of new that
     are not to be updated.
   """
+  @instrumented
   def updatePublication(self, old, new):
-    new_title, new_year, new_journal = new[0], new[1], new[2]
-    old_title, old_year, old_journal = old[0], old[1], old[2]
-    set1 = '' if not new_title else "title = '{0}'".format(new_title)
-    set2 = '' if not new_year else "year = {0}".format(new_year)
-    set3 = '' if not new_journal else "booktitle = '{0}'".format(new_journal)
-    set1 = set1 + "," if set1 and (set2 or set3) else set1
-    set2 = set2 + "," if set2 and set3 else set2
-    sql = """UPDATE publication SET {0}{1}{2} WHERE title = "{3}" and year = {4} and booktitle = "{5}";""".format(set1, set2, set3, old_title, old_year, old_journal)
+    sql, params = self.__updatePublicationSQL(old, new)
 
     try:
-      self.__conn.cursor().execute(sql).close()
-      self.__conn.commit()
+      with self.__writer() as conn:
+        self.__execute(conn.cursor(), sql, params).close()
+        conn.commit()
     except Error as e:
-      print(e)
+      self.__error(e)
+
+  """
+    Returns the tables, join conditions, filter conditions, and parameters of
+    the filter conditions that select the publications matching a query,
+    followed by the (condition, parameters) pair on author names that the
+    page's author lists are filtered by, or None. Fuzzy queries with words to
+    match go through 'publication_fts' when the database has it, and fuzzy
+    author names through 'author_token'.
+  """
+  def __queryConditions(self, record, exact=True):
+    author, title, year, journal = [toText(r) for r in record[:4]]
+    tables = ['publication as p', 'written_by as w', 'author as a']
+    joins = ['p.id = w.pub_id', 'w.author_id = a.id']
+    match = None if exact or not self.__tokens else self.__authorMatchSQL(author)
+    if exact:
+      filters = [
+        None if not author else ("lower(a.name) = ?", [author.lower()]),
+        None if not title else ("lower(p.title) = ?", [title.lower()]),
+        None if not year else ("p.year = ?", [year]),
+        None if not journal else ("lower(p.booktitle) = ?", [journal.lower()])]
+    elif self.__fts and self.__matchExpression(record):
+      words = re.findall(r'\w+', author or '', re.UNICODE)
+      tables.insert(0, 'publication_fts as f')
+      joins.insert(0, 'f.rowid = p.id')
+      filters = [
+        ("a.id IN ({0})".format(match[0]), match[1]) if match else
+        None if not words else ("lower(a.name) LIKE ?", ['%' + '%'.join(w.lower() for w in words) + '%']),
+        ("publication_fts MATCH ?", [self.__matchExpression(record)]),
+        None if not year else ("p.year = ?", [year])]
+    else:
+      filters = [
+        ("a.id IN ({0})".format(match[0]), match[1]) if match else
+        None if not author else ("lower(a.name) LIKE ?", ['%' + author.lower() + '%']),
+        None if not title else ("lower(p.title) LIKE ?", ['%' + title.lower() + '%']),
+        None if not year else ("p.year = ?", [year]),
+        None if not journal else ("lower(p.booktitle) LIKE ?", ['%' + journal.lower() + '%'])]
+
+    conds = [f for f in filters if f]
+    return tables, joins, [c for c, p in conds], [v for c, p in conds for v in p], filters[0]
+
+  """
+    Returns the expressions a page is ordered by for sorted_order. The
+    publication ID (and author ID for sorted_order='name') breaks ties so that
+    every row has a unique key to continue paging from. Setting
+    sorted_order='rank' orders fuzzy results by relevance. Raises an error for
+    any other sorted_order, which is never pasted into the sql.
+  """
+  def __sortKey(self, sorted_order, fts=False):
+    keys = {'title': ['p.title'],
+            'year': ['ifnull(p.year, 0)'],
+            'booktitle': ["ifnull(p.booktitle, '')"],
+            'journal': ["ifnull(p.booktitle, '')"],
+            'name': ['a.name'],
+            'rank': ['f.rank'] if fts else ['p.title']}
+    if sorted_order not in keys:
+      raise Error("Unknown sorted_order: {0}".format(sorted_order))
+    key = keys[sorted_order]
+
+    return key + (['p.id', 'a.id'] if sorted_order == 'name' else ['p.id'])
+
+  """
+    Returns the page sql string used by queryPublication, the condition on
+    author names that the page's author lists are filtered by, and the
+    parameters of the page sql, including its offset and limit. Each row holds
+    the publication's ID, title, year, and journal followed by its sort key.
+    With sorted_order='name' a page holds one row per matching (publication,
+    author) pair, with the author's name after the journal, instead of one row
+    per publication. If 'after' is a sort key, the page starts right after the
+    row with that key.
+  """
+  def __queryPublicationSQL(self, record, exact=True, sorted_order='title',
+      reverse=False, queryRange="0,50", after=None):
+    tables, joins, conds, params, author_cond = self.__queryConditions(record, exact)
+    key = self.__sortKey(sorted_order, 'publication_fts as f' in tables)
+    start, end = queryRange.split(',')[0], queryRange.split(',')[1]
+    if after is not None:
+      conds.append("({0}) {1} ({2})".format(', '.join(key), '<' if reverse else '>',
+                                            ', '.join(['?'] * len(key))))
+      params = params + list(after)
+
+    columns = "p.id, p.title, p.year, p.booktitle, a.name" if sorted_order == 'name' \
+      else "DISTINCT p.id, p.title, p.year, p.booktitle"
+
+    sql_pubs = """SELECT {0}, {1}
+                  FROM {2}
+                  WHERE {3}
+                  ORDER BY {4} LIMIT ?, ?;
+              """.format(columns, ', '.join(key), ', '.join(tables),
+                ' AND '.join(joins + conds),
+                ', '.join([k + ' DESC' if reverse else k for k in key]))
+
+    return sql_pubs, author_cond, params + [int(start), int(end)]
+
+  """
+    Returns the sql string that counts the results of a query without fetching
+    them and its parameters. Publications that are not filtered by author are
+    counted on their own, checking only that they have an author, rather than
+    through the join.
+  """
+  def __countPublicationSQL(self, record, exact=True, sorted_order='title'):
+    tables, joins, conds, params, author_cond = self.__queryConditions(record, exact)
+    if sorted_order == 'name':
+      count = 'count(*)'
+    elif author_cond:
+      count = 'count(DISTINCT p.id)'
+    else:
+      count = 'count(*)'
+      tables = [t for t in tables if t not in ['written_by as w', 'author as a']]
+      joins = [j for j in joins if 'w.' not in j] + \
+        ['EXISTS (SELECT 1 FROM written_by WHERE pub_id = p.id)']
+
+    return """SELECT {0} FROM {1} WHERE {2};""".format(count, ', '.join(tables),
+                                                       ' AND '.join(joins + conds)), params
+
+  """
+    Returns the FTS5 MATCH expression for the author, title, and journal of a
+    fuzzy query, where every word of a field must prefix a word in that column
+    of 'publication_fts'. The author is left to 'author_token' when the
+    database has it. Returns an empty string if none of them has words.
+  """
+  def __matchExpression(self, record):
+    author, title, journal = toText(record[0]), toText(record[1]), toText(record[3])
+    if self.__tokens:
+      author = None
+    columns = []
+    for column, term in [('authors', author), ('title', title), ('booktitle', journal)]:
+      words = re.findall(r'\w+', term or '', re.UNICODE)
+      if words:
+        columns.append('{0} : ({1})'.format(column,
+          ' AND '.join('"{0}"*'.format(w) for w in words)))
+
+    return ' AND '.join(columns)
+
+  """
+    Returns the sql string that fetches the authors of the publications on a
+    page with the IDs in the list ids, filtered by 'author_cond', and its
+    parameters. Rows come back in the order the authors were written.
+  """
+  def __pageAuthorsSQL(self, ids, author_cond=None):
+    size = paddedSize(len(ids))
+    return """SELECT w.pub_id, a.name FROM written_by as w, author as a
+              WHERE w.author_id = a.id AND w.pub_id IN ({0}) {1}
+              ORDER BY w.rowid;""".format(', '.join(['?'] * size),
+                'AND ' + author_cond[0] if author_cond else ''), \
+      list(ids) + [None] * (size - len(ids)) + (list(author_cond[1]) if author_cond else [])
+
+  """
+    Generator that runs the page query of queryPublication and yields each
+    (row, authors) pair as it is read from the cursor. Rows are fetched in
+    batches and the authors of each batch are looked up together. The sort key
+    of the last row is stored in page['key']. With metrics, the time spent
+    fetching rows and the rows returned are recorded, along with the rows
+    the page went through, counted as its offset plus the rows fetched, and
+    the author rows fetched, in 'publication_api_rows_scanned'. The page
+    query is checked against the slow-query threshold once all of its rows
+    have been fetched.
+  """
+  def __iterPage(self, record, exact, sorted_order, reverse, queryRange,
+      after=None, page=None):
+    sql_pubs, author_cond, params = self.__queryPublicationSQL(record, exact,
+        sorted_order, reverse, queryRange, after)
+    width = 5 if sorted_order == 'name' else 4
+    timed = self.metrics is not None
+    page_seconds = fetch_seconds = 0.0
+    scanned = {'page': int(queryRange.split(',')[0]), 'authors': 0}
+    returned = 0
+
+    conn = self.__reader()
+    cursor = conn.cursor()
+    author_cursor = conn.cursor()
+    try:
+      start = time.time() if timed else 0
+      self.__execute(cursor, sql_pubs, params, slow=False)
+      if timed:
+        page_seconds, start = time.time() - start, time.time()
+      while True:
+        rows = cursor.fetchmany(self.__batch_size)
+        if timed:
+          seconds = time.time() - start
+          page_seconds, fetch_seconds = page_seconds + seconds, fetch_seconds + seconds
+          scanned['page'] += len(rows)
+        if not rows:
+          break
+        authors = {}
+        if sorted_order != 'name':
+          start = time.time() if timed else 0
+          ids = [r[0] for r in rows]
+          sql_authors, author_params = self.__pageAuthorsSQL(ids, author_cond)
+          for pub_id, name in self.__execute(author_cursor, sql_authors, author_params):
+            authors.setdefault(pub_id, []).append(name)
+          if timed:
+            fetch_seconds += time.time() - start
+            scanned['authors'] += sum(len(a) for a in authors.values())
+        returned += len(rows)
+        for r in rows:
+          yield r[:width], authors.get(r[0], [])
+        if page is not None:
+          page['key'] = list(rows[-1][width:])
+        start = time.time() if timed else 0
+    finally:
+      cursor.close()
+      author_cursor.close()
+      if timed:
+        self.metrics.observe('publication_api_phase_seconds', fetch_seconds, phase='fetch')
+        for query, rows in scanned.items():
+          self.metrics.increment('publication_api_rows_scanned', rows, query=query)
+        self.metrics.increment('publication_api_rows_returned', returned)
+        self.__logSlowQuery(conn, sql_pubs, params, page_seconds)
+
+  """
+    Returns the list of serialized (row, authors) pairs, observing the time
+    spent serializing them when the API has metrics.
+  """
+  def __serialize(self, serialize, pairs):
+    if self.metrics is None:
+      return [serialize(row, authors) for row, authors in pairs]
+
+    results, seconds = [], 0.0
+    for row, authors in pairs:
+      start = time.time()
+      results.append(serialize(row, authors))
+      seconds += time.time() - start
+    self.metrics.observe('publication_api_phase_seconds', seconds, phase='serialize')
+
+    return results
 
   """
     Queries publications matching an author, title, year, or journal. If exact
     equals True, then only match return exact matches for the author, title,
     and journal. If exact equals False, then return similar matches for the
     author, title, and journal. Record is a list of the form:
-    [author, title, year, journal].
+    [author, title, year, journal]. Only the requested output_format is
+    computed. If total equals True, the number of all matching results is
+    returned instead of the number of results on the page. Results served from
+    the cache are shared between callers and must not be modified.
   """
+  @instrumented
   def queryPublication(self, record, exact=True, output_format='JSON',
+      sorted_order='title', reverse=False, queryRange="0,50", total=False):
+    self.__checkSnapshot()
+    if self.__cache_size > 0:
+      author, title, year, journal = record[0], record[1], record[2], record[3]
+      year = int(year) if year and str(year).isdigit() else year or None
+      key = ((author or '').lower(), (title or '').lower(), year, (journal or '').lower(),
+             bool(exact), output_format, sorted_order, bool(reverse),
+             queryRange.replace(' ', ''), bool(total))
+      with self.__cache_lock:
+        generation = self.__generation
+        entry = self.__cache.pop(key, None)
+        if entry is not None and entry[0] == generation:
+          self.__cache[key] = entry
+          self.__cache_stats['hits'] += 1
+          return entry[1]
+        self.__cache_stats['misses'] += 1
+
+    serialize = SERIALIZERS[output_format]
+
+    try:
+      results = self.__serialize(serialize,
+        self.__iterPage(record, exact, sorted_order, reverse, queryRange))
+      result = results, self.countPublication(record, exact, sorted_order) if total else len(results)
+    except Error as e:
+      self.__error(e)
+      return
+
+    if self.__cache_size > 0:
+      with self.__cache_lock:
+        self.__cache[key] = (generation, result)
+        while len(self.__cache) > self.__cache_size:
+          self.__cache.popitem(last=False)
+          self.__cache_stats['evictions'] += 1
+
+    return result
+
+  """
+    Returns the hit, miss, and eviction counts of the queryPublication result
+    cache along with its current size, capacity, and generation.
+  """
+  def cacheStats(self):
+    with self.__cache_lock:
+      stats = dict(self.__cache_stats)
+      stats.update({'size': len(self.__cache), 'capacity': self.__cache_size,
+                    'generation': self.__generation})
+
+    return stats
+
+  """
+    Returns the number of results queryPublication would find for a query
+    without fetching them.
+  """
+  @instrumented
+  def countPublication(self, record, exact=True, sorted_order='title'):
+    try:
+      cursor = self.__reader().cursor()
+      sql, params = self.__countPublicationSQL(record, exact, sorted_order)
+      count = self.__execute(cursor, sql, params).fetchone()[0]
+      cursor.close()
+      if self.metrics is not None:
+        self.metrics.increment('publication_api_rows_scanned', count, query='count')
+      return count
+    except Error as e:
+      self.__error(e)
+
+  """
+    Queries a page of publications like queryPublication, but continues from
+    the last page through its sort key instead of skipping an offset, so later
+    pages cost no more than the first. Returns the results, the token of the
+    next page (None on the last page), and the number of results on the page,
+    or of all matching results if total equals True. Pass the returned token
+    back with the same query, sorted_order, and reverse to get the next page.
+  """
+  @instrumented
+  def pagePublication(self, record, exact=True, output_format='JSON',
+      sorted_order='title', reverse=False, pageSize=50, token=None, total=False):
+    after = None
+    if token:
+      try:
+        if not isinstance(token, bytes):
+          token = token.encode('ascii')
+        state = json.loads(base64.urlsafe_b64decode(token).decode('utf-8'))
+        if state['order'] != sorted_order or state['reverse'] != reverse:
+          raise ValueError("Page token of another sort order")
+        after = state['key']
+      except (ValueError, TypeError, KeyError):
+        print("Invalid page token for this query")
+        return None
+
+    serialize = SERIALIZERS[output_format]
+    page = {}
+    try:
+      results = self.__serialize(serialize,
+        self.__iterPage(record, exact, sorted_order, reverse,
+                        "0,{0}".format(pageSize), after, page))
+      next_token = None
+      if len(results) == pageSize:
+        next_token = base64.urlsafe_b64encode(json.dumps(
+          {'order': sorted_order, 'reverse': reverse, 'key': page['key']}).encode('utf-8')).decode('ascii')
+      count = self.countPublication(record, exact, sorted_order) if total else len(results)
+      return results, next_token, count
+    except Error as e:
+      self.__error(e)
+
+  """
+    Generator version of queryPublication that yields one serialized chunk
+    per result as rows are read from the cursor: a JSON line for
+    output_format='JSON' or a '<pub>' element for output_format='XML'. With
+    metrics, the method's latency is observed once the stream is finished.
+  """
+  def streamPublication(self, record, exact=True, output_format='JSON',
       sorted_order='title', reverse=False, queryRange="0,50"):
-    author, title, year, journal = record[0], record[1], record[2], record[3]
-    start, end = queryRange.split(',')[0], queryRange.split(',')[1]
-    if exact:
-      cond1 = '' if not author else "lower(a.name) = '{0}'".format(author.lower())
-      cond2 = '' if not title else "lower(p.title) = '{0}'".format(title.lower())
-      cond3 = '' if not year else "p.year = {0}".format(year)
-      cond4 = '' if not journal else "lower(p.booktitle) = '{0}'".format(journal.lower())
-    else:
-      cond1 = '' if not author else "lower(a.name) LIKE '%{0}%'".format(author.lower())
-      cond2 = '' if not title else "lower(p.title) LIKE '%{0}%'".format(title.lower())
-      cond3 = '' if not year else "p.year = {0}".format(year)
-      cond4 = '' if not journal else "lower(p.booktitle) LIKE '%{0}%'".format(journal.lower())
-
-    cond1 = cond1 + " AND " if cond1 and (cond2 or cond3 or cond4) else cond1
-    cond2 = cond2 + " AND " if cond2 and (cond3 or cond4 ) else cond2
-    cond3 = cond3 + " AND " if cond3 and cond4 else cond3
-    cond5 = "AND " if cond1 or cond2 or cond3 or cond4 else ""
-    cond6 = "ORDER BY " + sorted_order + " DESC" if reverse else "ORDER BY " + sorted_order
-
-    sql_pubs = """SELECT DISTINCT p.id, p.title, p.year, p.booktitle
-                  FROM publication as p, written_by as w, author as a
-                  WHERE p.id = w.pub_id and w.author_id = a.id
-                  {4} {0}{1}{2}{3} {5} LIMIT {6},{7};
-              """.format(cond1, cond2, cond3, cond4, cond5, cond6, start, end)
-
-    sql_authors = """SELECT p.id, a.name
-                     FROM publication as p, written_by as w, author as a
-                     WHERE p.id = w.pub_id and w.author_id = a.id
-                     {4} {0}{1}{2}{3} {5};
-                  """.format(cond1, cond2, cond3, cond4, cond5, cond6)
+    serialize = STREAM_SERIALIZERS[output_format]
+    timed = self.metrics is not None
+    began, seconds = time.time(), 0.0
 
     try:
-      cursor = self.__conn.cursor()
-      result_pubs = cursor.execute(sql_pubs).fetchall()
-      result_authors = cursor.execute(sql_authors).fetchall()
+      for row, authors in self.__iterPage(record, exact, sorted_order, reverse, queryRange):
+        start = time.time() if timed else 0
+        chunk = serialize(row, authors)
+        if timed:
+          seconds += time.time() - start
+        yield chunk
+    except Error as e:
+      self.__error(e)
+    finally:
+      if timed:
+        self.metrics.observe('publication_api_phase_seconds', seconds, phase='serialize')
+        self.metrics.observe('publication_api_method_seconds', time.time() - began,
+                             method='streamPublication')
+
+  """
+    Writes the results of a query to the file-like object out as they are
+    streamed by streamPublication and returns the number of results written.
+  """
+  @instrumented
+  def writePublication(self, out, record, exact=True, output_format='JSON',
+      sorted_order='title', reverse=False, queryRange="0,50"):
+    count = 0
+    for chunk in self.streamPublication(record, exact, output_format,
+        sorted_order, reverse, queryRange):
+      out.write(chunk)
+      count += 1
+
+    return count
+
+  """
+    Returns the sql string that fetches the collaborators of the authors named
+    'author', matched case-insensitively, with the number of publications they
+    share, most shared first, and its parameters.
+  """
+  def __topCollaboratorsSQL(self, author, limit=10):
+    return """SELECT b.name, sum(c.count) FROM author as a, coauthor as c, author as b
+              WHERE lower(a.name) = lower(?) AND c.a = a.id AND b.id = c.b
+              GROUP BY c.b ORDER BY 2 DESC, b.name LIMIT ?;""", [toText(author), int(limit)]
+
+  """
+    Returns the sql string that fetches the publications written by both of
+    the authors named 'author1' and 'author2' and its parameters.
+  """
+  def __sharedPublicationsSQL(self, author1, author2):
+    return """SELECT DISTINCT p.id, p.title, p.year, p.booktitle
+              FROM author as a1, written_by as w1, written_by as w2, author as a2, publication as p
+              WHERE lower(a1.name) = lower(?) AND w1.author_id = a1.id
+                AND lower(a2.name) = lower(?) AND w2.author_id = a2.id
+                AND w2.pub_id = w1.pub_id AND p.id = w1.pub_id
+              ORDER BY p.title, p.id;""", [toText(author1), toText(author2)]
+
+  """
+    Returns the sql string that fetches the collaborators of the authors with
+    the IDs in the list ids and its parameters.
+  """
+  def __neighborsSQL(self, ids):
+    size = paddedSize(len(ids))
+    return """SELECT DISTINCT b FROM coauthor WHERE a IN ({0});""".format(
+      ', '.join(['?'] * size)), list(ids) + [None] * (size - len(ids))
+
+  """
+    Returns the list of the (name, count) pairs of the 'limit' authors who
+    have written the most publications with the author named 'author'.
+    Requires the 'coauthor' relation built by create.py.
+  """
+  @instrumented
+  def topCollaborators(self, author, limit=10):
+    try:
+      cursor = self.__reader().cursor()
+      sql, params = self.__topCollaboratorsSQL(author, limit)
+      collaborators = [(name, count) for name, count in self.__execute(cursor, sql, params)]
       cursor.close()
+      return collaborators
+    except Error as e:
+      self.__error(e)
 
-      def formatOutput(output_format):
-        def convertToJSON():
-          if sorted_order != 'name':
-            return [{
-              'title': r[1],
-              'authors': list(filter(None, [a[1] if a[0] == r[0] else None for a in result_authors])),
-              'year': r[2],
-              'journal': r[3],
-              } for r in result_pubs]
-          else:
-            return [{
-              'title': list(filter(None, [p[1] if p[0] == r[0] else None
-                for p in result_pubs]))[0],
-              'authors': r[1],
-              'year': list(filter(None, [p[2] if p[0] == r[0] else None
-                for p in result_pubs]))[0],
-              'journal':
-                  list(filter(None, [p[3]
-                    if p[0] == r[0] else None
-                    for p in result_pubs]))[0]
-                  if len(list(filter(None, [p[3]
-                      if p[0] == r[0] else None
-                      for p in result_pubs])))
-                  else ""
-              } for r in result_authors]
-            return result
-
-        def convertToXML():
-          if sorted_order != 'name':
-            results = []
-            for r in result_pubs:
-              res = '<pub>\n\t<title>' + r[1] + '</title>\n\t<authors>'
-              for a in result_authors:
-                res += '\n\t\t<author>{0}</author>'.format(a[1]) \
-                  if a[0] == r[0] else ''
-              res += '\n\t</authors>\n\t<year>' + str(r[2]) + \
-                '</year>\n\t<booktitle>' + r[3] + '</booktitle>'
-              results.append(res)
-            return results
-          else:
-            results = []
-            for r in result_pubs:
-              results.append('<pub>\n\t<title>' + r[1] +
-                '</title>\n\t<authors>' + '\n\t\t<author>' + r[1] + \
-                '</author>\n\t</authors>\n\t<year>' + str(r[2]) + \
-                '</year>\n\t<booktitle>' + r[3] + '</booktitle>')
-            return results
-
-            return [{
-              'title': list(filter(None, [p[1] if p[0] == r[0] else None
-                for p in result_pubs]))[0],
-              'authors': r[1],
-              'year': list(filter(None, [p[2] if p[0] == r[0] else None
-                for p in result_pubs]))[0],
-              'journal':
-                  list(filter(None, [p[3]
-                    if p[0] == r[0] else None
-                    for p in result_pubs]))[0]
-                  if len(list(filter(None, [p[3]
-                      if p[0] == r[0] else None
-                      for p in result_pubs])))
-                  else ""
-              } for r in result_authors]
-            return result
-
-
-        return {
-            'JSON': convertToJSON(),
-            'XML': convertToXML()
-            }[output_format]
-
-      return formatOutput(output_format), len(result_pubs)
+  """
+    Queries the publications written by both of the authors named 'author1'
+    and 'author2' and returns them in output_format along with their number,
+    like queryPublication.
+  """
+  @instrumented
+  def sharedPublications(self, author1, author2, output_format='JSON'):
+    serialize = SERIALIZERS[output_format]
+    try:
+      cursor = self.__reader().cursor()
+      sql, params = self.__sharedPublicationsSQL(author1, author2)
+      rows = self.__execute(cursor, sql, params).fetchall()
+      authors = {}
+      for i in range(0, len(rows), self.__batch_size):
+        sql, params = self.__pageAuthorsSQL([r[0] for r in rows[i:i + self.__batch_size]])
+        for pub_id, name in self.__execute(cursor, sql, params):
+          authors.setdefault(pub_id, []).append(name)
+      cursor.close()
+      results = self.__serialize(serialize, [(r, authors.get(r[0], [])) for r in rows])
+      return results, len(results)
     except Error as e:
-      print(e)
+      self.__error(e)
+
+  """
+    Loads the 'coauthor' relation into memory as a compressed sparse row
+    graph: the collaborators of the author with ID i are
+    neighbors[offsets[i]:offsets[i + 1]], and weights holds the number of
+    publications shared with each. The graph answers coauthorNeighborhood
+    without touching the database until the next write, after which that
+    method goes back to the database until the graph is loaded again.
+    Returns the number of (author, collaborator) pairs loaded.
+  """
+  @instrumented
+  def loadCoauthorGraph(self):
+    with self.__cache_lock:
+      generation = self.__generation
+    try:
+      cursor = self.__reader().cursor()
+      size = self.__execute(cursor, """SELECT ifnull(max(id), -1) + 2 FROM author;""").fetchone()[0]
+      offsets = array.array('i', [0]) * size
+      neighbors, weights = array.array('i'), array.array('i')
+      for a, b, count in self.__execute(cursor, """SELECT a, b, count FROM coauthor ORDER BY a, b;""",
+                                        slow=False):
+        offsets[a + 1] += 1
+        neighbors.append(b)
+        weights.append(count)
+      cursor.close()
+    except Error as e:
+      self.__error(e)
+      return
+    for i in range(1, size):
+      offsets[i] += offsets[i - 1]
+    self.__graph = {'generation': generation, 'offsets': offsets,
+                    'neighbors': neighbors, 'weights': weights}
+
+    return len(neighbors)
+
+  """
+    Returns the list of the (name, distance) pairs of the authors at most k
+    collaborations away from the author named 'author', nearest first and then
+    by name. Hops are expanded breadth first until one of them reaches
+    'limit' authors, and at most 'limit' authors are returned. Uses the graph
+    of loadCoauthorGraph if no write has happened since it was loaded and the
+    'coauthor' relation otherwise.
+  """
+  @instrumented
+  def coauthorNeighborhood(self, author, k=2, limit=1000):
+    self.__checkSnapshot()
+    graph = self.__graph
+    with self.__cache_lock:
+      if graph is not None and graph['generation'] != self.__generation:
+        graph = None
+
+    try:
+      cursor = self.__reader().cursor()
+      frontier = [author_id for author_id, in self.__execute(cursor,
+        """SELECT id FROM author WHERE lower(name) = lower(?);""", [toText(author)])]
+      distances = dict((author_id, 0) for author_id in frontier)
+      for hop in range(1, k + 1):
+        if not frontier or len(distances) - 1 >= limit:
+          break
+        found = []
+        if graph is not None:
+          offsets, neighbors = graph['offsets'], graph['neighbors']
+          for a in frontier:
+            if a + 1 < len(offsets):
+              found.extend(neighbors[offsets[a]:offsets[a + 1]])
+        else:
+          for i in range(0, len(frontier), self.__batch_size):
+            sql, params = self.__neighborsSQL(frontier[i:i + self.__batch_size])
+            found.extend(b for b, in self.__execute(cursor, sql, params))
+        frontier = []
+        for b in found:
+          if b not in distances:
+            distances[b] = hop
+            frontier.append(b)
+
+      for a in [a for a, d in distances.items() if d == 0]:
+        del distances[a]
+      ids, names = list(distances), {}
+      for i in range(0, len(ids), self.__batch_size):
+        chunk = ids[i:i + self.__batch_size]
+        size = paddedSize(len(chunk))
+        sql = """SELECT id, name FROM author WHERE id IN ({0});""".format(', '.join(['?'] * size))
+        names.update(self.__execute(cursor, sql, chunk + [None] * (size - len(chunk))))
+      cursor.close()
+    except Error as e:
+      self.__error(e)
+      return
+
+    return sorted(((names[a], d) for a, d in distances.items() if a in names),
+                  key=lambda pair: (pair[1], pair[0]))[:limit]
+
+  """
+    Returns the sql string that reads the number of publications with the
+    given year, journal, or both, or written by the authors named 'author',
+    from the summary tables built by create.py, and its parameters. Journals
+    and names are matched exactly (ignoring case).
+  """
+  def __aggregateCountSQL(self, year=None, journal=None, author=None):
+    if author:
+      return """SELECT sum(c.count) FROM author as a, author_count as c
+                WHERE lower(a.name) = lower(?) AND c.author_id = a.id;""", [toText(author)]
+    elif year and journal:
+      return """SELECT count FROM venue_year_count WHERE booktitle = ? AND year = ?;""", \
+        [toText(journal), int(year)]
+    elif journal:
+      return """SELECT count FROM venue_count WHERE booktitle = ?;""", [toText(journal)]
+    elif year:
+      return """SELECT count FROM year_count WHERE year = ?;""", [int(year)]
+
+    return """SELECT count FROM relation_count WHERE relation = ?;""", ['publication']
+
+  """
+    Returns the number of publications with the given year, journal, or both,
+    written by the author named 'author', or of all publications if nothing is
+    given. The count is read from a single row of the summary tables that
+    create.py builds and triggers keep exact, so it costs the same however
+    many publications match. An author may not be combined with a year or a
+    journal.
+  """
+  @instrumented
+  def aggregateCount(self, year=None, journal=None, author=None):
+    if author and (year or journal):
+      print("Author counts may not be combined with a year or journal")
+      return None
+
+    try:
+      cursor = self.__reader().cursor()
+      sql, params = self.__aggregateCountSQL(year, journal, author)
+      row = self.__execute(cursor, sql, params).fetchone()
+      cursor.close()
+      return row[0] or 0 if row else 0
+    except Error as e:
+      self.__error(e)
+
+  """
+    Returns the rows of one of the summary tables in order of their key:
+    by='relation' gives (relation, rows) pairs, by='year' (year, count),
+    by='journal' (journal, count), by='journal_year' (journal, year, count),
+    and by='author' (name, count).
+  """
+  @instrumented
+  def aggregateCounts(self, by='year'):
+    sql = AGGREGATE_COUNTS[by]
+    try:
+      cursor = self.__reader().cursor()
+      rows = [tuple(r) for r in self.__execute(cursor, sql)]
+      cursor.close()
+      return rows
+    except Error as e:
+      self.__error(e)
+
+  """
+    Runs EXPLAIN QUERY PLAN on the sql of every exact-match lookup made by the
+    API, of the fuzzy searches when 'publication_fts' exists, of the fuzzy
+    author deletes when 'author_token' exists, of the collaborator lookups
+    when 'coauthor' exists, and of the aggregate counts when the summary
+    tables exist, and returns a list of (sql, plan step) pairs for the steps
+    that fall back to a full table or index scan. An empty list means every
+    lookup is answered through an index.
+  """
+  def checkQueryPlans(self):
+    statements = [
+      self.__deleteAuthorSQL('name'),
+      self.__deletePublicationSQL(['title', 2000, 'journal']),
+      self.__updateAuthorSQL('name', 'name'),
+      self.__updatePublicationSQL(['title', 2000, 'journal'], ['title', 2000, 'journal'])
+    ]
+    if self.__tokens:
+      statements.extend([self.__deleteAuthorSQL('n. name', exact=False),
+                         ("""DELETE FROM author_token WHERE author_id = ?;""", [0])])
+    if self.__coauthors:
+      statements.extend([self.__topCollaboratorsSQL('name'),
+                         self.__sharedPublicationsSQL('name', 'other name'),
+                         self.__neighborsSQL(range(50))])
+    if self.__aggregates:
+      statements.extend([self.__aggregateCountSQL(*args) for args in
+                         [(), (2000,), (None, 'journal'), (2000, 'journal'), (None, None, 'name')]])
+    for record in [['name', '', None, ''], ['', 'title', None, ''],
+                   ['', '', 2000, ''], ['', '', None, 'journal'],
+                   ['', '', 2000, 'journal'], ['name', 'title', 2000, 'journal']]:
+      for sorted_order in ['title', 'year', 'booktitle', 'name']:
+        for exact in [True, False] if self.__fts else [True]:
+          for after in [None, range(3 if sorted_order == 'name' else 2)]:
+            sql_pubs, author_cond, params = self.__queryPublicationSQL(record,
+              exact, sorted_order, after=after)
+            statements.extend([(sql_pubs, params), self.__pageAuthorsSQL(range(50), author_cond)])
+          statements.append(self.__countPublicationSQL(record, exact, sorted_order))
+
+    scans = []
+    cursor = self.__reader().cursor()
+    for sql, params in statements:
+      for step in cursor.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall():
+        if step[-1].startswith('SCAN') and 'VIRTUAL TABLE' not in step[-1]:
+          scans.append((sql, step[-1]))
+    cursor.close()
+
+    return scans
 
 if __name__ == '__main__':
   api = PublicationAPI('../database.db')
@@ -262,7 +1460,7 @@ if __name__ == '__main__':
 
   first_attempt = api.queryPublication(["", "Big Data and Recommender Systems", 2016, ""])
 
-  if not first_attempt:
+  if not first_attempt or not first_attempt[0]:
     print("\nCalling queryPublication(['', 'Big Data and Recommender Systems', 2016, ''])...\nReturned nothing...\n\nCalling insertPublication(['Big Data and Recommender Systems', 2017, '', '', ['David C. Anastasiu', 'Evangelia Christakopoulou', 'Shaden Smith', 'Mohit Sharma']])...\n")
 
     api.insertPublication(["Big Data and Recommender Systems", 2016, "", "",
@@ -288,6 +1486,23 @@ if __name__ == '__main__':
   print(api.queryPublication(['', 'Big Data and Recommender Systems', 2016, ''], sorted_order='name'))
 
 
+  print("\n\n*********** Testing fuzzy title queries ************")
+
+  print("\nCalling queryPublication(['', 'big data recomm sys', None, ''], exact=False, sorted_order='rank')...")
+  fuzzy = api.queryPublication(['', 'big data recomm sys', None, ''], exact=False, sorted_order='rank')
+  print(fuzzy)
+  if "Big Data and Recommender Systems" not in [r['title'] for r in fuzzy[0]]:
+    raise SystemExit("The fuzzy title query did not find 'Big Data and Recommender Systems'")
+
+  print("\n\n*********** Testing fuzzy author queries ************")
+
+  for name in ["D. Anastasiu", "David Anastasiu", "anastasiu david"]:
+    print("\nCalling queryPublication(['{0}', 'big data recommender systems', 2016, ''], exact=False)...".format(name))
+    fuzzy = api.queryPublication([name, 'big data recommender systems', 2016, ''], exact=False)
+    print(fuzzy)
+    if not any("David C. Anastasiu" in r['authors'] for r in fuzzy[0]):
+      raise SystemExit("The fuzzy author query '{0}' did not find 'David C. Anastasiu'".format(name))
+
   print("\n\n*********** Testing updateAuthor and updatePublication ************")
 
   print("\nCalling updateAuthor('David C. Anastasiu', 'David Anastasiu')...")
@@ -302,6 +1517,12 @@ if __name__ == '__main__':
   print("\nCalling queryPublication(['', 'Really BIG Data and Recommender Systems', 2016, 'Some Journal'])...")
   print(api.queryPublication(['', 'Really BIG Data and Recommender Systems', 2016, 'Some Journal']))
 
+  print("\nCalling queryPublication(['David Anastasiu', 'big data recomm sys', None, 'some'], exact=False, sorted_order='rank')...")
+  fuzzy = api.queryPublication(['David Anastasiu', 'big data recomm sys', None, 'some'], exact=False, sorted_order='rank')
+  print(fuzzy)
+  if ("Really BIG Data and Recommender Systems", ["David Anastasiu"]) not in [(r['title'], r['authors']) for r in fuzzy[0]]:
+    raise SystemExit("The fuzzy query did not find the renamed publication and author")
+
   print("\n\n****** Testing deletePublication and deleteAuthor and foreign key constraints *******")
 
   print("\nCalling queryPublication(['', 'Really BIG Data and Recommender Systems', 2016, ''])...")
@@ -328,6 +1549,25 @@ if __name__ == '__main__':
   print("\nCalling queryPublication(['', 'Test Publication', None, ''])...")
   print(api.queryPublication(["", "Test Publication", None, ""]))
 
+  print("\n\n*********** Testing insertPublications ************")
+
+  print("\nCalling insertPublications([['Batch Publication One', 2015, 'Batch Journal', '', ['Batch Author']], ['Batch Publication Two', 2999, 'Batch Journal', '', ['Batch Author']], ['Batch Publication Three', 2016, 'Batch Journal', '', ['Batch Author', 'Other Batch Author']]])...")
+  failures = api.insertPublications([
+    ["Batch Publication One", 2015, "Batch Journal", "", ["Batch Author"]],
+    ["Batch Publication Two", 2999, "Batch Journal", "", ["Batch Author"]],
+    ["Batch Publication Three", 2016, "Batch Journal", "", ["Batch Author", "Other Batch Author"]]])
+  print(failures)
+  if [index for index, reason in failures] != [1]:
+    raise SystemExit("insertPublications did not reject only the record from the future")
+
+  print("\nCalling queryPublication(['Batch Author', '', None, 'Batch Journal'])...")
+  results, count = api.queryPublication(["Batch Author", "", None, "Batch Journal"])
+  print(results)
+  if count != 2:
+    raise SystemExit("insertPublications did not insert the valid records")
+  for title, year in [("Batch Publication One", 2015), ("Batch Publication Three", 2016)]:
+    api.deletePublication([title, year, "Batch Journal"])
+
   print("\n\n*********** Testing limited range query ************")
 
   print("\nCalling queryPublication(['', '', 2000, 'NIPS'], queryRange='0,5')...")
@@ -336,7 +1576,190 @@ if __name__ == '__main__':
   print("\nCalling queryPublication(['', '', 2000, 'NIPS'], queryRange='3,2')...")
   print(api.queryPublication(['', '', 2000, 'NIPS'], queryRange='3,2'))
 
+  print("\n\n*********** Testing pagePublication and total counts ************")
+
+  print("\nCalling pagePublication(['', '', 2000, 'NIPS'], pageSize=2) for three pages...")
+  pages, token = [], None
+  for i in range(3):
+    results, token, count = api.pagePublication(['', '', 2000, 'NIPS'], pageSize=2, token=token)
+    print(results)
+    pages.extend(results)
+    if token is None:
+      break
+  if pages != api.queryPublication(['', '', 2000, 'NIPS'], queryRange='0,{0}'.format(len(pages)))[0]:
+    raise SystemExit("pagePublication does not match queryPublication")
+
+  print("\nCalling queryPublication(['', '', 2000, 'NIPS'], queryRange='0,2', total=True)...")
+  results, total = api.queryPublication(['', '', 2000, 'NIPS'], queryRange='0,2', total=True)
+  print(total)
+  if total != api.countPublication(['', '', 2000, 'NIPS']) or \
+      total != len(api.queryPublication(['', '', 2000, 'NIPS'], queryRange='0,100000')[0]):
+    raise SystemExit("total does not match the number of results")
+
   print("\n\n*********** Testing XML output format ************")
 
   print("\nCalling queryPublication(['', '', 2000, 'NIPS'], output_format='XML',queryRange='3,1')...")
   print(api.queryPublication(['', '', 2000, 'NIPS'], output_format='XML', queryRange='3,1'))
+
+  print("\n\n*********** Testing the queryPublication cache ************")
+
+  cached = PublicationAPI('../database.db', cache_size=10)
+  print("\nCalling queryPublication(['', '', 2000, 'NIPS']) twice with cache_size=10...")
+  first = cached.queryPublication(['', '', 2000, 'NIPS'])
+  second = cached.queryPublication(['', '', 2000, 'NIPS'])
+  print(cached.cacheStats())
+  if second != first or cached.cacheStats()['hits'] != 1:
+    raise SystemExit("The repeated query was not served from the cache")
+
+  print("\nCalling insertPublication(['Cached Publication', 2000, 'NIPS', '', ['Cached Author']]) and querying again...")
+  cached.insertPublication(["Cached Publication", 2000, "NIPS", "", ["Cached Author"]])
+  third = cached.queryPublication(['', '', 2000, 'NIPS'])
+  print(cached.cacheStats())
+  if third[1] != first[1] + 1 or cached.cacheStats()['hits'] != 1:
+    raise SystemExit("The insert did not invalidate the cache")
+  cached.deletePublication(["Cached Publication", 2000, "NIPS"])
+  cached.deleteAuthor("Cached Author")
+  cached.close()
+
+  print("\n\n*********** Testing pooled and lazy modes ************")
+
+  print("\nCalling insertPublication(['Pooled Publication', 2015, 'Mode Journal', '', ['Mode Author']]) with pooled=True...")
+  pooled = PublicationAPI('../database.db', pooled=True)
+  pooled.insertPublication(["Pooled Publication", 2015, "Mode Journal", "", ["Mode Author"]])
+  print(pooled.queryPublication(["Mode Author", "", None, "Mode Journal"]))
+  if pooled.queryPublication(["Mode Author", "", None, "Mode Journal"])[1] != 1:
+    raise SystemExit("The pooled insert was not found")
+  pooled.close()
+
+  print("\nCalling insertPublication(['Lazy Publication', 2016, 'Mode Journal', '', ['MODE AUTHOR']]) with lazy=True...")
+  lazy = PublicationAPI('../database.db', lazy=True)
+  lazy.insertPublication(["Lazy Publication", 2016, "Mode Journal", "", ["MODE AUTHOR"]])
+  results, count = lazy.queryPublication(["Mode Author", "", None, "Mode Journal"])
+  print(results)
+  if count != 2 or [r['authors'] for r in results] != [["Mode Author"], ["Mode Author"]]:
+    raise SystemExit("The lazy insert added a second author for a case variant")
+  check = sqlite3.connect('../database.db')
+  rows = check.execute("""SELECT count(*) FROM author WHERE lower(name) = 'mode author';""").fetchone()[0]
+  check.close()
+  if rows != 1:
+    raise SystemExit("The lazy insert created {0} author rows for a case variant".format(rows))
+  for title, year in [("Pooled Publication", 2015), ("Lazy Publication", 2016)]:
+    lazy.deletePublication([title, year, "Mode Journal"])
+  lazy.deleteAuthor("Mode Author")
+  lazy.close()
+
+  print("\n\n*********** Testing streamPublication ************")
+
+  print("\nCalling streamPublication(['', '', 2000, 'NIPS'], queryRange='0,3')...")
+  chunks = list(api.streamPublication(['', '', 2000, 'NIPS'], queryRange='0,3'))
+  print(''.join(chunks))
+  if [json.loads(chunk) for chunk in chunks] != api.queryPublication(['', '', 2000, 'NIPS'], queryRange='0,3')[0]:
+    raise SystemExit("streamPublication does not match queryPublication")
+
+  print("\n\n*********** Testing collaborator queries ************")
+
+  collaborations = [["Collaboration One", 2015, "Smoke Journal", "", ["Smoke Author A", "Smoke Author B"]],
+                    ["Collaboration Two", 2016, "Smoke Journal", "", ["Smoke Author A", "Smoke Author B", "Smoke Author C"]],
+                    ["Collaboration Three", 2016, "Smoke Journal", "", ["Smoke Author C", "Smoke Author D"]]]
+  api.insertPublications(collaborations)
+
+  print("\nCalling topCollaborators('Smoke Author A')...")
+  print(api.topCollaborators("Smoke Author A"))
+  if api.topCollaborators("Smoke Author A") != [("Smoke Author B", 2), ("Smoke Author C", 1)]:
+    raise SystemExit("topCollaborators does not count the shared publications")
+
+  print("\nCalling sharedPublications('Smoke Author A', 'Smoke Author B')...")
+  print(api.sharedPublications("Smoke Author A", "Smoke Author B"))
+  if api.sharedPublications("Smoke Author A", "Smoke Author B")[1] != 2:
+    raise SystemExit("sharedPublications does not find both shared publications")
+
+  print("\nCalling coauthorNeighborhood('Smoke Author A', k=2) before and after loadCoauthorGraph()...")
+  neighborhood = api.coauthorNeighborhood("Smoke Author A", k=2)
+  print(neighborhood)
+  api.loadCoauthorGraph()
+  if neighborhood != [("Smoke Author B", 1), ("Smoke Author C", 1), ("Smoke Author D", 2)] or \
+      api.coauthorNeighborhood("Smoke Author A", k=2) != neighborhood:
+    raise SystemExit("coauthorNeighborhood does not find the authors two hops away")
+
+  for title, year, journal, pages, authors in collaborations:
+    api.deletePublication([title, year, journal])
+  print("\nCalling deleteAuthor('Smoke Author A', exact=False)...")
+  api.deleteAuthor("Smoke Author A", exact=False)
+  check = sqlite3.connect('../database.db')
+  remaining = [name for name, in check.execute(
+    """SELECT name FROM author WHERE name LIKE 'Smoke Author _' ORDER BY name;""")]
+  check.close()
+  print(remaining)
+  if remaining != ["Smoke Author B", "Smoke Author C", "Smoke Author D"]:
+    raise SystemExit("deleteAuthor('Smoke Author A', exact=False) removed {0}".format(remaining))
+  for author in ["Smoke Author B", "Smoke Author C", "Smoke Author D"]:
+    api.deleteAuthor(author)
+  if api.topCollaborators("Smoke Author C"):
+    raise SystemExit("Deleting the publications did not remove their collaborations")
+
+  print("\n\n*********** Testing aggregateCount ************")
+
+  print("\nCalling aggregateCount() and aggregateCount(2000, 'NIPS')...")
+  before = [api.aggregateCount(), api.aggregateCount(2000, "NIPS")]
+  print(before)
+  if before[1] != api.countPublication(["", "", 2000, "NIPS"]):
+    raise SystemExit("aggregateCount does not match countPublication")
+
+  print("\nCalling insertPublication(['Counted Publication', 2000, 'NIPS', '', ['Counted Author']]) and counting again...")
+  api.insertPublication(["Counted Publication", 2000, "NIPS", "", ["Counted Author"]])
+  after = [api.aggregateCount(), api.aggregateCount(2000, "NIPS"), api.aggregateCount(author="Counted Author")]
+  print(after)
+  if after != [before[0] + 1, before[1] + 1, 1]:
+    raise SystemExit("The summary tables did not count the insert")
+  api.deletePublication(["Counted Publication", 2000, "NIPS"])
+  api.deleteAuthor("Counted Author")
+  if [api.aggregateCount(), api.aggregateCount(2000, "NIPS")] != before:
+    raise SystemExit("The summary tables did not count the delete")
+
+  print("\n\n*********** Testing snapshot mode ************")
+
+  snapshot = PublicationAPI('../database.db', cache_size=10, snapshot='memory')
+  print("\nCalling queryPublication(['', '', 2000, 'NIPS']) on a snapshot...")
+  first = snapshot.queryPublication(['', '', 2000, 'NIPS'])
+  print(first)
+  if first != api.queryPublication(['', '', 2000, 'NIPS']):
+    raise SystemExit("The snapshot does not match the database")
+
+  print("\nCalling insertPublication(['Snapshot Publication', 2000, 'NIPS', '', ['Snapshot Author']]) on the snapshot...")
+  error = snapshot.insertPublication(["Snapshot Publication", 2000, "NIPS", "", ["Snapshot Author"]])
+  if not error:
+    raise SystemExit("The snapshot accepted a write")
+
+  print("\nInserting it through the database and calling refreshSnapshot()...")
+  api.insertPublication(["Snapshot Publication", 2000, "NIPS", "", ["Snapshot Author"]])
+  if not snapshot.refreshSnapshot() or snapshot.queryPublication(['', '', 2000, 'NIPS'])[1] != first[1] + 1:
+    raise SystemExit("The snapshot did not pick up the write")
+  api.deletePublication(["Snapshot Publication", 2000, "NIPS"])
+  api.deleteAuthor("Snapshot Author")
+  snapshot.close()
+
+  print("\n\n*********** Testing the slow-query log ************")
+
+  from Metrics import Metrics
+  metrics = Metrics(slow_query_seconds=0.0)
+  timed = PublicationAPI('../database.db', metrics=metrics)
+  print("\nCalling queryPublication(['Anastasiu', '', None, '']) with exact=False and a zero threshold...")
+  timed.queryPublication(['Anastasiu', '', None, ''], exact=False)
+  print("\nCalling queryPublication([u'Jos\\xe9 Garc\\xeda', '', None, ''])...")
+  timed.queryPublication([u'Jos\xe9 Garc\xeda', '', None, ''])
+  slow = metrics.slowQueries()
+  print("{0} queries logged".format(len(slow)))
+  if not slow or not any(u'jos\xe9' in p.lower() for entry in slow for p in entry['params']
+                         if isinstance(p, type(u''))):
+    raise SystemExit("The slow-query log is missing the text parameters")
+  timed.close()
+
+  print("\n\n*********** Testing query plans ************")
+
+  print("\nCalling checkQueryPlans()...")
+  scans = api.checkQueryPlans()
+  for sql, step in scans:
+    print("{0}\n  -> {1}".format(' '.join(sql.split()), step))
+  if scans:
+    raise SystemExit("{0} queries fall back to a full scan".format(len(scans)))
+  print("Every query is answered through an index.")